@@ -11,6 +11,7 @@ from flask_cors import CORS
 from werkzeug.utils import secure_filename
 import uuid
 import json
+import threading
 from datetime import datetime
 
 # Import workflow modules
@@ -20,7 +21,7 @@ try:
     from edi_analyzer import EDIAnalyzer
     from output_formats import OutputGenerator
     from business_docs_analyzer import BusinessDocsAnalyzer
-    from website_analyzer import WebsiteAnalyzer
+    from website_analyzer import WebsiteAnalyzer, collect_links_and_images, fetch_html
     from contract_analyzer import ContractAnalyzer
     from salary_slip_analyzer import SalarySlipAnalyzer
 except ImportError as e:
@@ -31,6 +32,8 @@ except ImportError as e:
     OutputGenerator = None
     BusinessDocsAnalyzer = None
     WebsiteAnalyzer = None
+    collect_links_and_images = None
+    fetch_html = None
     ContractAnalyzer = None
     SalarySlipAnalyzer = None
 
@@ -43,6 +46,9 @@ try:
     # LangChain imports
     from langchain_openai import OpenAIEmbeddings, ChatOpenAI
     from langchain_community.vectorstores import FAISS
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    import faiss
+    import numpy as np
     from langchain_text_splitters import CharacterTextSplitter
     from langchain_core.prompts import PromptTemplate
     from langchain_core.runnables import RunnablePassthrough
@@ -56,11 +62,60 @@ app = Flask(__name__, static_url_path="", static_folder=".", template_folder="te
 CORS(app)
 
 UPLOAD_FOLDER = "uploads"
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Uploads are processed from memory; the raw files are only kept on disk when opted in
+PERSIST_UPLOADS = os.getenv("PERSIST_UPLOADS", "").lower() in ("1", "true", "yes")
+if PERSIST_UPLOADS:
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+EDI_EXTENSIONS = ('.edi', '.txt', '.baplie', '.movins', '.coprar')
 
 retriever_cache = {}
 chat_history_store = {}  # Store chat histories for sharing
 file_store = {}  # Store multiple files for comparison
+# Guards the shared stores above; gunicorn runs requests on worker threads
+_state_lock = threading.Lock()
+
+def _get_retriever(key):
+    with _state_lock:
+        return retriever_cache.get(key)
+
+def _get_retrievers(*keys):
+    """Look up several retrievers in one snapshot of retriever_cache"""
+    with _state_lock:
+        return [retriever_cache.get(key) for key in keys]
+
+def _persist_upload(data, path):
+    """Save uploaded bytes to disk on a background thread so the request isn't blocked"""
+    if not PERSIST_UPLOADS:
+        return
+    def _write():
+        try:
+            with open(path, "wb") as f:
+                f.write(data)
+        except OSError as e:
+            print(f"Warning: Could not save upload to {path}: {e}")
+    threading.Thread(target=_write, daemon=True).start()
+
+# Documents that chunk beyond this size get an HNSW index instead of a flat scan
+HNSW_MIN_CHUNKS = 2000
+
+def _build_vectorstore(docs, embeddings):
+    """Build a FAISS store; large documents use HNSW for sub-linear retrieval"""
+    if len(docs) <= HNSW_MIN_CHUNKS:
+        return FAISS.from_documents(docs, embeddings)
+    vectors = embeddings.embed_documents([doc.page_content for doc in docs])
+    index = faiss.IndexHNSWFlat(len(vectors[0]), 32)
+    index.add(np.array(vectors, dtype="float32"))
+    ids = [str(uuid.uuid4()) for _ in docs]
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore(dict(zip(ids, docs))),
+        index_to_docstore_id=dict(enumerate(ids)),
+    )
+
+def _decode_text(data):
+    """Decode uploaded text bytes, normalizing newlines like a text-mode open() would"""
+    return data.decode("utf-8", "ignore").replace("\r\n", "\n").replace("\r", "\n")
 
 @app.route("/", methods=["GET"])
 def serve_index():
@@ -159,7 +214,8 @@ def tool_website_summary():
 # Share and export endpoints
 @app.route("/share/<share_id>", methods=["GET"])
 def share_page(share_id):
-    chat_data = chat_history_store.get(share_id)
+    with _state_lock:
+        chat_data = chat_history_store.get(share_id)
     if not chat_data:
         return render_template("404.html"), 404
     return render_template("share.html", chat_data=chat_data, share_id=share_id)
@@ -168,11 +224,12 @@ def share_page(share_id):
 def save_chat():
     data = request.get_json()
     share_id = str(uuid.uuid4())[:8]
-    chat_history_store[share_id] = {
-        "messages": data.get("messages", []),
-        "created_at": datetime.now().isoformat(),
-        "share_id": share_id
-    }
+    with _state_lock:
+        chat_history_store[share_id] = {
+            "messages": data.get("messages", []),
+            "created_at": datetime.now().isoformat(),
+            "share_id": share_id
+        }
     return jsonify({"share_id": share_id, "share_url": f"/share/{share_id}"})
 
 @app.route("/api/export-pdf", methods=["POST"])
@@ -189,7 +246,7 @@ def workflow_extract_insights():
     try:
         data = request.get_json()
         document_type = data.get("document_type", "general")
-        retriever = retriever_cache.get("active")
+        retriever = _get_retriever("active")
         
         if not retriever:
             return jsonify({"error": "Please upload a document first"}), 400
@@ -211,7 +268,7 @@ def workflow_extract_insights():
 def workflow_action_items():
     """Generate action items"""
     try:
-        retriever = retriever_cache.get("active")
+        retriever = _get_retriever("active")
         if not retriever:
             return jsonify({"error": "Please upload a document first"}), 400
         
@@ -234,7 +291,7 @@ def workflow_summary():
     try:
         data = request.get_json()
         summary_type = data.get("type", "executive")
-        retriever = retriever_cache.get("active")
+        retriever = _get_retriever("active")
         
         if not retriever:
             return jsonify({"error": "Please upload a document first"}), 400
@@ -258,7 +315,7 @@ def workflow_email_draft():
     try:
         data = request.get_json()
         email_type = data.get("type", "summary")
-        retriever = retriever_cache.get("active")
+        retriever = _get_retriever("active")
         
         if not retriever:
             return jsonify({"error": "Please upload a document first"}), 400
@@ -280,7 +337,7 @@ def workflow_email_draft():
 def workflow_risk_analysis():
     """Produce risk analysis"""
     try:
-        retriever = retriever_cache.get("active")
+        retriever = _get_retriever("active")
         if not retriever:
             return jsonify({"error": "Please upload a document first"}), 400
         
@@ -306,8 +363,7 @@ def workflow_compare():
         file_id_2 = data.get("file_id_2")
         comparison_type = data.get("type", "general")
         
-        retriever1 = retriever_cache.get(file_id_1)
-        retriever2 = retriever_cache.get(file_id_2) if file_id_2 else retriever_cache.get("active")
+        retriever1, retriever2 = _get_retrievers(file_id_1, file_id_2 or "active")
         
         if not retriever1 or not retriever2:
             return jsonify({"error": "Please upload both documents first"}), 400
@@ -341,8 +397,7 @@ def resume_ats_score():
         data = request.get_json()
         jd_file_id = data.get("jd_file_id")
         
-        resume_retriever = retriever_cache.get("active")
-        jd_retriever = retriever_cache.get(jd_file_id) if jd_file_id else None
+        resume_retriever, jd_retriever = _get_retrievers("active", jd_file_id)
         
         if not resume_retriever:
             return jsonify({"error": "Please upload a resume first"}), 400
@@ -367,8 +422,7 @@ def resume_match_jd():
         data = request.get_json()
         jd_file_id = data.get("jd_file_id")
         
-        resume_retriever = retriever_cache.get("active")
-        jd_retriever = retriever_cache.get(jd_file_id)
+        resume_retriever, jd_retriever = _get_retrievers("active", jd_file_id)
         
         if not resume_retriever or not jd_retriever:
             return jsonify({"error": "Please upload both resume and job description"}), 400
@@ -393,7 +447,7 @@ def resume_rewrite():
         data = request.get_json()
         improvements = data.get("improvements", [])
         
-        resume_retriever = retriever_cache.get("active")
+        resume_retriever = _get_retriever("active")
         if not resume_retriever:
             return jsonify({"error": "Please upload a resume first"}), 400
         
@@ -417,8 +471,7 @@ def resume_full_report():
         data = request.get_json()
         jd_file_id = data.get("jd_file_id")
         
-        resume_retriever = retriever_cache.get("active")
-        jd_retriever = retriever_cache.get(jd_file_id) if jd_file_id else None
+        resume_retriever, jd_retriever = _get_retrievers("active", jd_file_id)
         
         if not resume_retriever:
             return jsonify({"error": "Please upload a resume first"}), 400
@@ -440,7 +493,7 @@ def resume_full_report():
 def resume_grammar_analysis():
     """Analyze grammar and clarity"""
     try:
-        resume_retriever = retriever_cache.get("active")
+        resume_retriever = _get_retriever("active")
         if not resume_retriever:
             return jsonify({"error": "Please upload a resume first"}), 400
         
@@ -464,8 +517,7 @@ def resume_skill_gaps():
         data = request.get_json()
         jd_file_id = data.get("jd_file_id")
         
-        resume_retriever = retriever_cache.get("active")
-        jd_retriever = retriever_cache.get(jd_file_id)
+        resume_retriever, jd_retriever = _get_retrievers("active", jd_file_id)
         
         if not resume_retriever or not jd_retriever:
             return jsonify({"error": "Please upload both resume and job description"}), 400
@@ -490,8 +542,7 @@ def resume_keyword_optimization():
         data = request.get_json()
         jd_file_id = data.get("jd_file_id")
         
-        resume_retriever = retriever_cache.get("active")
-        jd_retriever = retriever_cache.get(jd_file_id) if jd_file_id else None
+        resume_retriever, jd_retriever = _get_retrievers("active", jd_file_id)
         
         if not resume_retriever:
             return jsonify({"error": "Please upload a resume first"}), 400
@@ -556,22 +607,23 @@ def analyze_edi():
             if file.filename:
                 filename = secure_filename(file.filename)
                 path = os.path.join(UPLOAD_FOLDER, filename)
-                file.save(path)
                 
                 # Read as text if EDI file
                 file_ext = filename.lower()
-                is_edi_file = any(file_ext.endswith(ext) for ext in ['.edi', '.txt', '.baplie', '.movins', '.coprar'])
+                is_edi_file = file_ext.endswith(EDI_EXTENSIONS)
                 
                 if is_edi_file:
-                    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
-                        edi_content = f.read()
+                    # Decode straight from the upload stream instead of re-reading the saved copy
+                    data = file.read()
+                    _persist_upload(data, path)
+                    edi_content = _decode_text(data)
                 else:
                     return jsonify({"error": "Please upload an EDI file (.edi, .txt, .baplie, .movins, .coprar)"}), 400
             else:
                 return jsonify({"error": "No file provided"}), 400
         else:
             # Try to get from cache
-            retriever = retriever_cache.get("active")
+            retriever = _get_retriever("active")
             if not retriever:
                 return jsonify({"error": "Please upload an EDI document first"}), 400
             
@@ -598,7 +650,7 @@ def analyze_edi():
             # Create retriever for LLM analysis
             docs = CharacterTextSplitter(chunk_size=1000, chunk_overlap=100).create_documents([edi_content])
             embeddings = OpenAIEmbeddings(openai_api_key=openai_key)
-            vectordb = FAISS.from_documents(docs, embeddings)
+            vectordb = _build_vectorstore(docs, embeddings)
             retriever = vectordb.as_retriever()
             
             # Get full analysis
@@ -721,21 +773,23 @@ def upload_multi():
         
         filename = secure_filename(file.filename)
         path = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(path)
         
         # Detect file type by extension
         file_ext = filename.lower()
-        is_edi_file = any(file_ext.endswith(ext) for ext in ['.edi', '.txt', '.baplie', '.movins', '.coprar'])
+        is_edi_file = file_ext.endswith(EDI_EXTENSIONS)
         
         text = ""
         
         if is_edi_file:
-            # Read EDI/text files as plain text
-            with open(path, 'r', encoding='utf-8', errors='ignore') as f:
-                text = f.read()
+            # Read EDI/text files as plain text straight from the upload stream
+            data = file.read()
+            _persist_upload(data, path)
+            text = _decode_text(data)
         elif filename.endswith(".pdf"):
-            # Read PDF files
-            doc = fitz.open(path)
+            # Read PDF files from memory rather than re-opening the saved copy
+            data = file.read()
+            _persist_upload(data, path)
+            doc = fitz.open(stream=data, filetype="pdf")
             for page in doc:
                 text += page.get_text()
             doc.close()
@@ -749,11 +803,12 @@ def upload_multi():
         
         openai_key = os.getenv("OPENAI_API_KEY")
         embeddings = OpenAIEmbeddings(openai_api_key=openai_key)
-        vectordb = FAISS.from_documents(docs, embeddings)
+        vectordb = _build_vectorstore(docs, embeddings)
         
         # Create retriever with more documents returned for better content extraction
-        retriever_cache[file_id] = vectordb.as_retriever(search_kwargs={"k": 20})
-        file_store[file_id] = {"filename": filename, "uploaded_at": datetime.now().isoformat(), "fileType": "edi" if is_edi_file else "pdf"}
+        with _state_lock:
+            retriever_cache[file_id] = vectordb.as_retriever(search_kwargs={"k": 20})
+            file_store[file_id] = {"filename": filename, "uploaded_at": datetime.now().isoformat(), "fileType": "edi" if is_edi_file else "pdf"}
         
         return jsonify({"message": "File uploaded successfully", "file_id": file_id, "fileType": "edi" if is_edi_file else "pdf"})
     except Exception as e:
@@ -768,7 +823,7 @@ def upload_multi():
 def business_docs_analyze():
     """Analyze business document"""
     try:
-        retriever = retriever_cache.get("active")
+        retriever = _get_retriever("active")
         if not retriever:
             return jsonify({"error": "Please upload a document first"}), 400
         
@@ -778,7 +833,10 @@ def business_docs_analyze():
         
         if BusinessDocsAnalyzer:
             analyzer = BusinessDocsAnalyzer(openai_key)
-            analysis = analyzer.analyze_business_doc(retriever)
+            # Optional declared type (e.g. from the upload form) skips type detection
+            data = request.get_json(silent=True)
+            hint = data.get("documentType") if isinstance(data, dict) else None
+            analysis = analyzer.analyze_business_doc(retriever, hint=hint)
             return jsonify(analysis)
         else:
             return jsonify({"error": "BusinessDocsAnalyzer not available"}), 500
@@ -789,7 +847,7 @@ def business_docs_analyze():
 def contract_analyze():
     """Professional contract analysis endpoint"""
     try:
-        retriever = retriever_cache.get("active")
+        retriever = _get_retriever("active")
         if not retriever:
             return jsonify({"error": "Please upload a contract first"}), 400
         
@@ -808,11 +866,34 @@ def contract_analyze():
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
+@app.route("/api/contract/aspects", methods=["POST"])
+def contract_aspects():
+    """Per-aspect contract analysis: metadata, summary, obligations, risks, missing/key clauses, improvements"""
+    try:
+        retriever = _get_retriever("active")
+        if not retriever:
+            return jsonify({"error": "Please upload a contract first"}), 400
+        
+        openai_key = os.getenv("OPENAI_API_KEY")
+        if not openai_key:
+            return jsonify({"error": "OPENAI_API_KEY not configured"}), 500
+        
+        if ContractAnalyzer:
+            analyzer = ContractAnalyzer(openai_key)
+            analysis = analyzer.analyze_aspects(retriever)
+            return jsonify(analysis)
+        else:
+            return jsonify({"error": "ContractAnalyzer not available"}), 500
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
 @app.route("/api/salary-slip/analyze", methods=["POST"])
 def salary_slip_analyze():
     """Professional salary slip analysis endpoint"""
     try:
-        retriever = retriever_cache.get("active")
+        retriever = _get_retriever("active")
         if not retriever:
             return jsonify({"error": "Please upload a salary slip first"}), 400
         
@@ -849,16 +930,11 @@ def analyze_website():
         
         # Fetch URL server-side
         try:
-            page = requests.get(url, timeout=15, headers={
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'en-US,en;q=0.5'
-            }, allow_redirects=True)
-            page.raise_for_status()
+            html = fetch_html(url)
         except requests.exceptions.RequestException as e:
             return jsonify({"error": f"Could not fetch URL: {str(e)}"}), 400
         
-        soup = BeautifulSoup(page.text, "html.parser")
+        soup = BeautifulSoup(html, "html.parser")
         
         # Extract structured data
         title = soup.find('title')
@@ -869,8 +945,7 @@ def analyze_website():
         h2_tags = [h.get_text().strip() for h in soup.find_all('h2')]
         h3_tags = [h.get_text().strip() for h in soup.find_all('h3')]
         
-        links = [a.get('href') for a in soup.find_all('a', href=True)]
-        images = [img.get('src') or img.get('data-src') for img in soup.find_all('img')]
+        links, images = collect_links_and_images(soup)
         
         # Clean text content
         for script in soup(["script", "style"]):
@@ -886,7 +961,7 @@ def analyze_website():
             return jsonify({"error": "OPENAI_API_KEY not configured"}), 500
         
         embeddings = OpenAIEmbeddings(openai_api_key=openai_key)
-        vectordb = FAISS.from_documents(docs, embeddings)
+        vectordb = _build_vectorstore(docs, embeddings)
         retriever = vectordb.as_retriever()
         
         if WebsiteAnalyzer:
@@ -901,10 +976,10 @@ def analyze_website():
                 "h1Tags": h1_tags,
                 "h2Tags": h2_tags,
                 "h3Tags": h3_tags,
-                "links": links[:50],
-                "images": images[:20],
+                "links": links,
+                "images": images,
                 "content": text[:10000],
-                "html": page.text[:5000]
+                "html": html[:5000]
             }
             
             # Get full analysis
@@ -1032,22 +1107,24 @@ def upload_file():
 
         filename = secure_filename(file.filename)
         path = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(path)
 
         # Detect file type by extension
         file_ext = filename.lower()
-        is_edi_file = any(file_ext.endswith(ext) for ext in ['.edi', '.txt', '.baplie', '.movins', '.coprar'])
+        is_edi_file = file_ext.endswith(EDI_EXTENSIONS)
         
         text = ""
         
         if is_edi_file:
-            # Read EDI/text files as plain text
-            with open(path, 'r', encoding='utf-8', errors='ignore') as f:
-                text = f.read()
+            # Read EDI/text files as plain text straight from the upload stream
+            data = file.read()
+            _persist_upload(data, path)
+            text = _decode_text(data)
         elif filename.endswith(".pdf"):
-            # Read PDF files
+            # Read PDF files from memory rather than re-opening the saved copy
             try:
-                doc = fitz.open(path)
+                data = file.read()
+                _persist_upload(data, path)
+                doc = fitz.open(stream=data, filetype="pdf")
                 for page in doc:
                     page_text = page.get_text()
                     if page_text:
@@ -1077,9 +1154,10 @@ def upload_file():
             return jsonify({"error": "OPENAI_API_KEY not configured. Please set your OpenAI API key in environment variables."}), 500
         
         embeddings = OpenAIEmbeddings(openai_api_key=openai_key)
-        vectordb = FAISS.from_documents(docs, embeddings)
+        vectordb = _build_vectorstore(docs, embeddings)
         # Create retriever with more documents returned (k=20 for better coverage)
-        retriever_cache["active"] = vectordb.as_retriever(search_kwargs={"k": 20})
+        with _state_lock:
+            retriever_cache["active"] = vectordb.as_retriever(search_kwargs={"k": 20})
 
         return jsonify({"message": "✅ File uploaded and processed successfully.", "fileType": "edi" if is_edi_file else "pdf"})
 
@@ -1101,16 +1179,11 @@ def fetch_url():
             url = 'https://' + url
 
         try:
-            page = requests.get(url, timeout=15, headers={
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'en-US,en;q=0.5'
-            }, allow_redirects=True)
-            page.raise_for_status()
+            html = fetch_html(url)
         except requests.exceptions.RequestException as e:
             return jsonify({"error": f"Could not fetch URL: {str(e)}"}), 400
 
-        soup = BeautifulSoup(page.text, "html.parser")
+        soup = BeautifulSoup(html, "html.parser")
         text = soup.get_text()
 
         if not text.strip():
@@ -1123,8 +1196,9 @@ def fetch_url():
             return jsonify({"error": "OPENAI_API_KEY not configured. Please set your OpenAI API key in environment variables."}), 500
         
         embeddings = OpenAIEmbeddings(openai_api_key=openai_key)
-        vectordb = FAISS.from_documents(docs, embeddings)
-        retriever_cache["active"] = vectordb.as_retriever()
+        vectordb = _build_vectorstore(docs, embeddings)
+        with _state_lock:
+            retriever_cache["active"] = vectordb.as_retriever()
 
         return jsonify({"message": "✅ Website content fetched and processed."})
 
@@ -1138,7 +1212,7 @@ def fetch_url():
 def ask_question():
     try:
         query = request.json.get("question")
-        retriever = retriever_cache.get("active")
+        retriever = _get_retriever("active")
         if not retriever:
             return jsonify({"error": "Please upload a file or fetch a website first."}), 400
 
@@ -1184,5 +1258,7 @@ Answer:"""
         return jsonify({"error": str(e)}), 500
 
 if __name__ == "__main__":
+    # Local development only. In production run gunicorn with threaded workers, e.g.
+    #   gunicorn -c gunicorn_config.py app:app --bind 0.0.0.0:$PORT
     port = int(os.environ.get("PORT", 8080))
-    app.run(host="0.0.0.0", port=port)
+    app.run(host="0.0.0.0", port=port, threaded=True)
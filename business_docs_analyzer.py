@@ -2,65 +2,429 @@
 Business Documents Analyzer Module
 Handles invoices, contracts, proposals, salary slips, reports, and office PDFs
 """
+import hashlib
 import json
+import os
 import re
-from typing import Dict, List, Any
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import PromptTemplate
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from typing import Dict, List, Any, Optional
+import numpy as np
+from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from llm_utils import extract_json_span, http_client, loads, stored_docs, trim_text
 from workflows import WorkflowProcessor
 
 # No external dependencies - self-contained extraction
 
+# Placeholder values the LLM tends to invent when a document has no real table data
+_SAMPLE_RE = re.compile(r'\b(product [abc]|sample|example|test)\b', re.IGNORECASE)
+
+# Keyword in the model's answer -> document type, checked in order
+_DOC_TYPE_KEYWORDS = (
+    ("invoice", "Invoice"),
+    ("contract", "Contract"),
+    ("proposal", "Proposal"),
+    ("salary", "Salary Slip"),
+    ("payroll", "Salary Slip"),
+    ("report", "Report"),
+)
+
+# Unambiguous phrases in the document itself; a match skips both the embedding and the LLM
+_RULE_PATTERNS = (
+    (re.compile(r'\btax invoice\b|\binvoice\s*(?:no\b\.?|number\b|#)\s*[:#.]?\s*[A-Z0-9/-]*\d', re.IGNORECASE), "Invoice"),
+    (re.compile(r'\b(?:salary slip|pay\s?slip|net pay)\b', re.IGNORECASE), "Salary Slip"),
+    (re.compile(r'\b(?:this agreement|party of the first part|hereinafter referred to as)\b', re.IGNORECASE), "Contract"),
+)
+
+# Label descriptions for the embedding classifier; the LLM is only asked when the
+# top two labels are closer than _TYPE_MIN_MARGIN
+_DOC_TYPE_DESCRIPTIONS = (
+    ("Invoice", "An invoice or bill with vendor and buyer details, line items, quantities, prices, taxes and a total amount due"),
+    ("Contract", "A legal contract or agreement between parties with clauses, obligations, terms, termination and liability provisions"),
+    ("Proposal", "A business proposal or quotation describing scope of work, deliverables, timeline and proposed pricing"),
+    ("Salary Slip", "A salary slip or payslip showing an employee's earnings, allowances, deductions and net pay for a pay period"),
+    ("Report", "A business report with findings, analysis, metrics, charts and conclusions"),
+    ("Office Document", "A general office document such as a letter, memo, notice, form or meeting notes"),
+)
+_TYPE_MIN_MARGIN = 0.05
+_label_matrix: Optional[np.ndarray] = None
+_label_matrix_lock = threading.Lock()
+
+# Fixed-format invoice fields that can be read without the LLM
+_DATE = r'(\d{1,2}[/\-.]\d{1,2}[/\-.]\d{2,4}|\d{4}-\d{2}-\d{2}|\d{1,2}[\s\-][A-Za-z]{3,9}[\s\-,]+\d{4}|[A-Za-z]{3,9}\s+\d{1,2},?\s+\d{4})'
+_INVOICE_NO_RE = re.compile(r'(?i:invoice|inv|bill)\s*(?i:no|number|num|#)\.?\s*[:#\-]?\s*((?=[A-Z\-/]*\d)[A-Z0-9][A-Z0-9\-/]{2,})')
+_INVOICE_DATE_RE = re.compile(r'(?i:invoice\s*date|issue\s*date|date\s*of\s*issue)\s*[:\-]?\s*' + _DATE)
+_DUE_DATE_RE = re.compile(r'(?i:due\s*date|payment\s*due|due\s*on)\s*[:\-]?\s*' + _DATE)
+_CURRENCY_RE = re.compile(r'\b(INR|USD|EUR|GBP|AUD|CAD|SGD|AED|JPY|CNY)\b')
+_GSTIN_RE = re.compile(r'\b\d{2}[A-Z]{5}\d{4}[A-Z][1-9A-Z]Z[0-9A-Z]\b')
+# A PAN embedded in a GSTIN has a digit before it, so \b keeps it from matching there
+_PAN_RE = re.compile(r'\b[A-Z]{5}\d{4}[A-Z]\b')
+_IFSC_RE = re.compile(r'\b[A-Z]{4}0[A-Z0-9]{6}\b')
+_SWIFT_RE = re.compile(r'(?i:swift|bic)(?i:\s*code)?\s*[:\-]?\s*([A-Z]{6}[A-Z0-9]{2}(?:[A-Z0-9]{3})?)\b')
+
+
+# Every extraction prompt gets the same document slice, so repeat analyses send
+# byte-identical text and OpenAI's prompt cache can reuse the tokenized document.
+# The budget is in tokens when tiktoken is available, characters otherwise
+CONTEXT_TOKENS = 3000
+CONTEXT_CHARS = 10000
+# Raw chunk text gathered before boilerplate removal and trimming down to the context budget
+FORMAT_CHARS = 2 * CONTEXT_CHARS
+# Only lines up to this length can be dropped as repeated headers/footers
+_BOILERPLATE_MAX_LEN = 80
+
+# Classification and table extraction are mechanical and go to the fast model;
+# the combined invoice and negotiation analyses can be routed to a stronger one
+FAST_MODEL = os.getenv("BUSINESS_DOCS_FAST_MODEL", "gpt-4o-mini")
+MAIN_MODEL = os.getenv("BUSINESS_DOCS_MODEL", "gpt-4o-mini")
+
+# One retrieval shared by type detection, table extraction and the invoice analysis
+UNION_QUERY = "invoice bill number vendor buyer line items products services amount totals payment terms"
+
+DOC_TYPE_TEMPLATE = """Identify the type of this business document.
+
+Is this an: Invoice, Contract, Proposal, Salary Slip, Report, or Other Office Document?
+
+Return ONLY the document type name.
+
+Document: {context}
+"""
+
+TABLES_TEMPLATE = """Extract all tables, line items, and structured data from this document. Extract ONLY the actual data present in the document - do NOT create sample or example data.
+
+Return a JSON object with a "tables" key holding an array of tables, each with:
+- tableName: name/description of the table (e.g., "Line Items", "Invoice Items", "Products")
+- headers: [array of column headers found in the document]
+- rows: [array of row objects with actual column values from the document]
+- totalAmount: total amount if found in the document
+- currency: currency code if found in the document
+
+IMPORTANT: 
+- Extract ONLY data that actually exists in the document
+- Do NOT create sample data like "Product A", "Product B"
+- Do NOT create example dates like "2022-01-01"
+- If no data is found, return {{"tables": []}}
+- Use the exact values, dates, and items from the document
+
+Document: {context}
+"""
+
+NEGOTIATION_TEMPLATE = """Identify negotiation points and key terms in this contract.
+
+Return a JSON object with:
+- keyTerms: [list of important terms]
+- negotiationPoints: [list of points that could be negotiated]
+- redFlags: [list of concerning clauses]
+- favorableTerms: [list of favorable terms]
+
+Contract: {context}
+"""
+
+# Extraction, risk and payment analysis share one request
+INVOICE_TEMPLATE = """Extract ALL data from this invoice accurately, then analyze its risks and payment terms. Extract EXACT values from the document - do NOT create sample or example data.
+
+Return a JSON object with exactly three top-level keys: extractedData, riskAnalysis, paymentAnalysis.
+
+1. extractedData: object with
+- invoiceNumber: exact invoice number from document
+- invoiceDate: exact date from document
+- dueDate: exact due date from document
+- vendorName: exact vendor/seller name from document
+- vendorAddress: exact vendor address from document
+- vendorGST: GST number if present
+- vendorPAN: PAN number if present
+- buyerName: exact buyer/recipient name from document
+- buyerAddress: exact buyer address from document
+- buyerGST: GST number if present
+- buyerPAN: PAN number if present
+- subtotal: subtotal amount as number (remove currency symbols)
+- taxBreakdown: array of tax objects, each with taxType (e.g., "CGST", "SGST", "IGST", "GST"), taxRate (as number), taxAmount (as number), taxableAmount (as number)
+- discount: discount amount as number (0 if not present)
+- shippingCharges: shipping amount as number (0 if not present)
+- totalAmount: total amount as number from document
+- currency: currency code (e.g., "USD", "INR", "₹", "$")
+- paymentTerms: exact payment terms from document
+- paymentMethod: payment method if mentioned
+- paymentTransactionID: transaction ID if present
+- lineItems: array of line item objects, each with itemNumber, description, quantity (as number), unitPrice (as number), totalPrice (as number), taxRate (as number), taxAmount (as number), category
+- lineItemsCount: total number of line items
+- lineItemsTotal: sum of all line item totalPrice values
+
+2. riskAnalysis: comprehensive risk and compliance analysis based on the values in extractedData, an object with: risks (array of risk objects), complianceIssues (array), missingInformation (array), duplicateCharges (array), suspiciousPatterns (array).
+Each risk object should have: title, description (3-5 sentences), severity (high/medium/low), category, evidence, impact, recommendation, affectedAmount.
+
+3. paymentAnalysis: analysis of payment terms and payment-related information, an object with: paymentTerms (object with terms, dueDate, daysUntilDue, earlyPaymentDiscount, latePaymentPenalty, paymentMethods), paymentStatus, bankDetails (object with accountNumber, bankName, ifscCode, swiftCode if found in document), recommendations (array).
+
+IMPORTANT:
+- Extract ONLY actual values from the document
+- Use exact names, dates, and amounts as they appear
+- Convert amounts to numbers (remove currency symbols and commas)
+- Verify calculations: subtotal + sum of all taxes - discount + shipping = totalAmount
+- If calculations don't match, note it in calculationErrors
+
+Known fields (already read from the document - omit these keys from extractedData): {known_fields}
+
+Invoice Document: {context}
+"""
+
+
+def _looks_like_sample(row: Dict[str, Any]) -> bool:
+    """True if any string value in the row matches a placeholder pattern"""
+    return any(isinstance(v, str) and _SAMPLE_RE.search(v) for v in row.values())
+
+
+def _is_sample_data(tables: List[Any]) -> bool:
+    """True if the first table looks LLM-invented; placeholders can trail real rows, so look past the first"""
+    if not tables or not isinstance(tables[0], dict) or not tables[0].get('rows'):
+        return False
+    return any(isinstance(row, dict) and _looks_like_sample(row) for row in tables[0]['rows'][:3])
+
+
+def _decode_json(result: str) -> Any:
+    """Parse a JSON-mode response, raising ValueError when it is malformed"""
+    try:
+        return loads(result)
+    except ValueError:  # json.JSONDecodeError and orjson.JSONDecodeError
+        # Salvage the first balanced object if the model wrapped it in text anyway
+        json_span = extract_json_span(result)
+        if json_span and json_span != result:
+            try:
+                return loads(json_span)
+            except ValueError:
+                pass
+        raise
+
+
+def _parse_json(result: str, label: str) -> Any:
+    """Parse a JSON-mode response, logging and returning None when it is malformed"""
+    try:
+        return _decode_json(result)
+    except ValueError as e:
+        print(f"Error parsing {label} JSON: {e}")
+        return None
+
+
+# Transient API failures are retried by the chains with exponential backoff and
+# jitter; the client itself fails fast so a stalled call can't hold a whole analysis
+_RETRY = {
+    "retry_if_exception_type": (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError),
+    "wait_exponential_jitter": True,
+    "stop_after_attempt": 4,
+}
+LLM_TIMEOUT = 60
+
+# Process-wide exact-match cache of LLM responses; analyzers are built per request,
+# so re-analyzing the same document hits this instead of the API
+_RESPONSE_CACHE_SIZE = 512
+_response_cache: "OrderedDict[str, str]" = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+
+def _cache_get(key: str):
+    with _response_cache_lock:
+        if key in _response_cache:
+            _response_cache.move_to_end(key)
+            return _response_cache[key]
+    return None
+
+
+def _cache_put(key: str, value: str):
+    with _response_cache_lock:
+        _response_cache[key] = value
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > _RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+
+
+class _CachedPrompt:
+    """A template rendered with str.format and sent straight to the model.
+    
+    No PromptTemplate/StrOutputParser layers: the prompt is one human message and
+    the reply is the message content. Identical prompts reuse the cached response;
+    for JSON prompts only replies that parse are cached, so a truncated reply is
+    retried on the next request instead of being served again.
+    """
+    
+    def __init__(self, template_id: str, template: str, llm, json_reply: bool = False):
+        self.template_id = template_id
+        self.template = template
+        self.llm = llm
+        self.json_reply = json_reply
+    
+    def _render(self, inputs: Dict[str, Any]) -> str:
+        return self.template.format(**inputs)
+    
+    def _key(self, prompt: str) -> str:
+        return hashlib.sha256(f"{self.template_id}\x00{prompt}".encode("utf-8")).hexdigest()
+    
+    def _store(self, key: str, result: str):
+        if self.json_reply:
+            try:
+                _decode_json(result)
+            except ValueError:
+                return
+        _cache_put(key, result)
+    
+    def invoke(self, inputs: Dict[str, Any]) -> str:
+        prompt = self._render(inputs)
+        key = self._key(prompt)
+        result = _cache_get(key)
+        if result is None:
+            result = self.llm.invoke(prompt).content
+            self._store(key, result)
+        return result
+    
+    def batch(self, inputs: List[Dict[str, Any]], config=None) -> List[str]:
+        prompts = [self._render(i) for i in inputs]
+        keys = [self._key(p) for p in prompts]
+        results = [_cache_get(k) for k in keys]
+        misses = [n for n, r in enumerate(results) if r is None]
+        if misses:
+            fresh = self.llm.batch([prompts[n] for n in misses], config=config)
+            for n, message in zip(misses, fresh):
+                results[n] = message.content
+                self._store(keys[n], message.content)
+        return results
+
 
 class BusinessDocsAnalyzer:
     def __init__(self, openai_key: str):
-        self.llm = ChatOpenAI(temperature=0, openai_api_key=openai_key)
-        self.output_parser = StrOutputParser()
-        self.workflow = WorkflowProcessor(openai_key)
+        # Static instructions lead every prompt and {context} comes last, so the
+        # shared prefix is eligible for OpenAI's automatic prompt caching
+        self.llm = ChatOpenAI(
+            model=MAIN_MODEL,
+            temperature=0,
+            openai_api_key=openai_key,
+            max_retries=0,
+            timeout=LLM_TIMEOUT,
+            http_client=http_client
+        )
+        if FAST_MODEL == MAIN_MODEL:
+            self.llm_fast = self.llm
+        else:
+            self.llm_fast = ChatOpenAI(
+                model=FAST_MODEL,
+                temperature=0,
+                openai_api_key=openai_key,
+                max_retries=0,
+                timeout=LLM_TIMEOUT,
+                http_client=http_client
+            )
+        # JSON mode: the API guarantees a single JSON object, no preamble or markdown fences.
+        # Bound rather than re-instantiated so calls on a model share one connection pool
+        self.json_llm = self.llm.bind(response_format={"type": "json_object"}).with_retry(**_RETRY)
+        self.fast_json_llm = self.llm_fast.bind(response_format={"type": "json_object"}).with_retry(**_RETRY)
+        self.embeddings = OpenAIEmbeddings(model="text-embedding-3-small", openai_api_key=openai_key)
+        self._openai_key = openai_key
+        # Fixed prompts are bound to their model once per analyzer
+        self._type_chain = _CachedPrompt("doc_type", DOC_TYPE_TEMPLATE, self.llm_fast.with_retry(**_RETRY))
+        self._tables_chain = _CachedPrompt("tables", TABLES_TEMPLATE, self.fast_json_llm, json_reply=True)
+        self._negotiation_chain = _CachedPrompt("negotiation", NEGOTIATION_TEMPLATE, self.json_llm, json_reply=True)
+        self._invoice_chain = _CachedPrompt("invoice", INVOICE_TEMPLATE, self.json_llm, json_reply=True)
+        # Per-retriever memoization; an analyzer lives for one request, during which
+        # the retriever is held by the app's retriever_cache, so id() stays unique
+        self._content_cache: Dict[Any, List] = {}
+        self._doc_type_cache: Dict[int, str] = {}
+        self._tables_cache: Dict[int, List[Dict[str, Any]]] = {}
+    
+    @cached_property
+    def workflow(self) -> WorkflowProcessor:
+        """Built on first use; invoice analyses never need it"""
+        return WorkflowProcessor(self._openai_key)
+    
+    @staticmethod
+    def _format_docs(docs, max_chars: int = FORMAT_CHARS) -> str:
+        """Join chunks, dropping duplicate chunks and short page headers/footers repeated across them"""
+        chunks = []
+        seen = set()
+        budget = max_chars
+        for doc in docs:
+            # Whole-chunk key: chunks that only share a leading header are both kept
+            key = hashlib.sha1(" ".join(doc.page_content.split()).lower().encode("utf-8")).digest()
+            if key not in seen:
+                seen.add(key)
+                chunks.append(doc.page_content)
+                # Stop once the budget is spent rather than joining every chunk and slicing
+                budget -= len(doc.page_content) + 2
+                if budget <= 0:
+                    break
+        
+        if len(chunks) < 3:
+            return "\n\n".join(chunks)
+        
+        # A short digit-free line present in at least half the chunks is boilerplate; keep its
+        # first occurrence only. Lines with digits are never dropped so amounts and quantities
+        # survive, and longer lines are treated as real text even when they repeat
+        line_counts = Counter()
+        for chunk in chunks:
+            line_counts.update({
+                line.strip() for line in chunk.splitlines()
+                if 0 < len(line.strip()) <= _BOILERPLATE_MAX_LEN and not any(ch.isdigit() for ch in line)
+            })
+        threshold = max(3, len(chunks) // 2)
+        emitted = set()
+        cleaned = []
+        for chunk in chunks:
+            lines = []
+            for line in chunk.splitlines():
+                stripped = line.strip()
+                if stripped and line_counts[stripped] >= threshold:
+                    if stripped in emitted:
+                        continue
+                    emitted.add(stripped)
+                lines.append(line)
+            cleaned.append("\n".join(lines))
+        return "\n\n".join(cleaned)
+    
+    def _get_docs(self, retriever, query: str) -> List:
+        """Retrieve documents for a query, reusing earlier results for the same retriever"""
+        key = (id(retriever), query)
+        if key not in self._content_cache:
+            if hasattr(retriever, 'get_relevant_documents'):
+                self._content_cache[key] = retriever.get_relevant_documents(query)
+            else:
+                self._content_cache[key] = []
+        return self._content_cache[key]
+    
+    def _multi_query_docs(self, retriever, queries: List[str]) -> List[List]:
+        """Run several retrieval queries with one embeddings request and concurrent searches"""
+        vectorstore = getattr(retriever, 'vectorstore', None)
+        embeddings = getattr(vectorstore, 'embeddings', None)
+        if embeddings is None or not hasattr(vectorstore, 'similarity_search_by_vector'):
+            with ThreadPoolExecutor(max_workers=len(queries)) as pool:
+                return list(pool.map(lambda q: self._get_docs(retriever, q), queries))
+        
+        k = getattr(retriever, 'search_kwargs', {}).get('k', 4)
+        vectors = embeddings.embed_documents(queries)
+        with ThreadPoolExecutor(max_workers=len(queries)) as pool:
+            return list(pool.map(lambda v: vectorstore.similarity_search_by_vector(v, k=k), vectors))
     
     def _extract_invoice_content(self, retriever):
         """Extract invoice content with multiple fallback strategies - self-contained"""
-        def format_docs(docs):
-            return "\n\n".join(doc.page_content for doc in docs)
-        
         content = ""
         docs = []
         
-        # Strategy 1: Search for invoice-specific terms
-        if hasattr(retriever, 'get_relevant_documents'):
-            search_queries = [
-                "invoice bill invoice number vendor buyer amount total payment",
-                "invoice",
-                "bill",
-                "vendor buyer amount"
-            ]
-            for query in search_queries:
-                try:
-                    temp_docs = retriever.get_relevant_documents(query)
+        # Strategy 1: One union query over invoice-specific terms
+        try:
+            docs = self._get_docs(retriever, UNION_QUERY)
+            content = self._format_docs(docs)
+        except:
+            pass
+        
+        # Strategy 2: Broader search, all queries at once
+        if len(content.strip()) < 200:
+            try:
+                for temp_docs in self._multi_query_docs(retriever, ["document", "text", "content"]):
                     if temp_docs:
-                        temp_content = format_docs(temp_docs)
+                        temp_content = self._format_docs(temp_docs)
                         if len(temp_content.strip()) > len(content.strip()):
                             content = temp_content
                             docs = temp_docs
-                except:
-                    continue
-        
-        # Strategy 2: Broader search
-        if len(content.strip()) < 200:
-            broad_queries = ["document", "text", "content", ""]
-            for query in broad_queries:
-                try:
-                    if hasattr(retriever, 'get_relevant_documents'):
-                        temp_docs = retriever.get_relevant_documents(query)
-                        if temp_docs:
-                            temp_content = format_docs(temp_docs)
-                            if len(temp_content.strip()) > len(content.strip()):
-                                content = temp_content
-                                docs = temp_docs
-                except:
-                    continue
+            except Exception as e:
+                print(f"Broad invoice search failed: {e}")
         
         # Strategy 3: Direct vectorstore access
         if len(content.strip()) < 200:
@@ -73,9 +437,9 @@ class BusinessDocsAnalyzer:
                 
                 if vectorstore:
                     try:
-                        all_docs = vectorstore.similarity_search("", k=200)
+                        all_docs = stored_docs(vectorstore)
                         if all_docs:
-                            temp_content = format_docs(all_docs)
+                            temp_content = self._format_docs(all_docs)
                             if len(temp_content.strip()) > len(content.strip()):
                                 content = temp_content
                                 docs = all_docs
@@ -86,135 +450,164 @@ class BusinessDocsAnalyzer:
         
         return content, docs
     
-    def detect_document_type(self, retriever) -> str:
-        """Detect the type of business document"""
-        template = """Identify the type of this business document.
-        
-Document: {context}
-
-Is this an: Invoice, Contract, Proposal, Salary Slip, Report, or Other Office Document?
-
-Return ONLY the document type name.
-"""
-        
-        def format_docs(docs):
-            return "\n\n".join(doc.page_content for doc in docs)
-        
-        docs = retriever.get_relevant_documents("document") if hasattr(retriever, 'get_relevant_documents') else []
-        content = format_docs(docs) if docs else ""
-        
-        prompt = PromptTemplate.from_template(template)
-        chain = prompt | self.llm | self.output_parser
-        
-        result = chain.invoke({"context": content[:3000]})
+    def detect_document_type(self, retriever, hint: Optional[str] = None) -> str:
+        """Detect the type of business document.
+        
+        `hint` is anything the caller already knows (a declared type or the filename);
+        when it names a known type no classification is done.
+        """
+        key = id(retriever)
+        if key not in self._doc_type_cache:
+            self._doc_type_cache[key] = self._hint_type(hint) or self._detect_document_type(retriever)
+        return self._doc_type_cache[key]
+    
+    def _detect_document_type(self, retriever) -> str:
+        inputs = self._type_input(retriever)
+        doc_type = self._rule_classify(inputs["context"]) or self._embed_classify([inputs["context"]])[0]
+        if doc_type:
+            return doc_type
+        result = self._type_chain.invoke(inputs)
+        return self._classify_doc_type(result)
+    
+    def _label_vectors(self) -> np.ndarray:
+        """Unit-norm embeddings of the label descriptions, computed once per process"""
+        global _label_matrix
+        with _label_matrix_lock:
+            if _label_matrix is None:
+                vectors = np.asarray(self.embeddings.embed_documents([d for _, d in _DOC_TYPE_DESCRIPTIONS]), dtype=np.float32)
+                _label_matrix = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+            return _label_matrix
+    
+    def _embed_classify(self, contexts: List[str]) -> List[Optional[str]]:
+        """Classify documents by cosine similarity to the label descriptions.
+        
+        Returns None for a document whose best two labels are too close to call
+        (or when embedding fails), leaving it to the LLM.
+        """
+        labels: List[Optional[str]] = [None] * len(contexts)
+        todo = [n for n, c in enumerate(contexts) if c.strip()]
+        if not todo:
+            return labels
+        try:
+            queries = np.asarray(self.embeddings.embed_documents([contexts[n] for n in todo]), dtype=np.float32)
+            queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+            scores = queries @ self._label_vectors().T
+        except Exception as e:
+            print(f"Embedding classification failed, falling back to LLM: {e}")
+            return labels
+        
+        for n, row in zip(todo, scores):
+            second, best = np.argsort(row)[-2:]
+            if row[best] - row[second] >= _TYPE_MIN_MARGIN:
+                labels[n] = _DOC_TYPE_DESCRIPTIONS[best][0]
+        return labels
+    
+    def _type_input(self, retriever) -> Dict[str, str]:
+        docs = self._get_docs(retriever, UNION_QUERY)
+        content = self._format_docs(docs) if docs else ""
+        return {"context": content[:3000]}
+    
+    @staticmethod
+    def _hint_type(hint: Optional[str]) -> Optional[str]:
+        if not hint:
+            return None
+        hint = hint.lower()
+        return next((name for keyword, name in _DOC_TYPE_KEYWORDS if keyword in hint), None)
+    
+    @staticmethod
+    def _rule_classify(context: str) -> Optional[str]:
+        return next((name for pattern, name in _RULE_PATTERNS if pattern.search(context)), None)
+    
+    @staticmethod
+    def _classify_doc_type(result: str) -> str:
+        """Map the model's free-text answer onto a known document type"""
         doc_type = result.strip().lower()
-        
-        if "invoice" in doc_type:
-            return "Invoice"
-        elif "contract" in doc_type:
-            return "Contract"
-        elif "proposal" in doc_type:
-            return "Proposal"
-        elif "salary" in doc_type or "payroll" in doc_type:
-            return "Salary Slip"
-        elif "report" in doc_type:
-            return "Report"
-        else:
-            return "Office Document"
+        return next((name for keyword, name in _DOC_TYPE_KEYWORDS if keyword in doc_type), "Office Document")
     
-    def extract_tables(self, retriever) -> List[Dict[str, Any]]:
-        """Extract tables and line items from document"""
-        template = """Extract all tables, line items, and structured data from this document. Extract ONLY the actual data present in the document - do NOT create sample or example data.
-        
-Document: {context}
-
-Return a JSON array of tables, each with:
-- tableName: name/description of the table (e.g., "Line Items", "Invoice Items", "Products")
-- headers: [array of column headers found in the document]
-- rows: [array of row objects with actual column values from the document]
-- totalAmount: total amount if found in the document
-- currency: currency code if found in the document
-
-IMPORTANT: 
-- Extract ONLY data that actually exists in the document
-- Do NOT create sample data like "Product A", "Product B"
-- Do NOT create example dates like "2022-01-01"
-- If no data is found, return an empty array
-- Use the exact values, dates, and items from the document
-
-Return ONLY valid JSON array, no additional text.
-"""
-        
-        def format_docs(docs):
-            return "\n\n".join(doc.page_content for doc in docs)
-        
-        docs = retriever.get_relevant_documents("invoice line items products services") if hasattr(retriever, 'get_relevant_documents') else []
+    def _get_context(self, retriever) -> str:
+        """Document text shared by table extraction, workflow and contract calls"""
+        docs = self._get_docs(retriever, UNION_QUERY)
         if not docs:
             # Try broader search
-            docs = retriever.get_relevant_documents("document") if hasattr(retriever, 'get_relevant_documents') else []
+            docs = self._get_docs(retriever, "document")
         
-        content = format_docs(docs) if docs else ""
+        return self._format_docs(docs) if docs else ""
+    
+    def extract_tables(self, retriever, content: str = None) -> List[Dict[str, Any]]:
+        """Extract tables and line items from document (reuses content when already retrieved)"""
+        key = id(retriever)
+        if key in self._tables_cache:
+            return self._tables_cache[key]
+        
+        if content is None:
+            content = self._get_context(retriever)
         
         if not content or len(content.strip()) < 50:
             # Not enough content to extract
             return []
         
-        prompt = PromptTemplate.from_template(template)
-        chain = prompt | self.llm | self.output_parser
-        
-        result = chain.invoke({"context": content[:8000]})  # Increased context window
-        
-        try:
-            if result.strip().startswith('['):
-                parsed = json.loads(result)
-                # Validate that it's not sample data
-                if parsed and len(parsed) > 0:
-                    first_table = parsed[0]
-                    if first_table.get('rows'):
-                        first_row = first_table['rows'][0]
-                        # Check for common sample data patterns
-                        sample_patterns = ['Product A', 'Product B', 'Product C', 'Sample', 'Example', 'Test']
-                        row_str = json.dumps(first_row).lower()
-                        if any(pattern.lower() in row_str for pattern in sample_patterns):
-                            # Likely sample data, return empty
-                            return []
-                return parsed
-            import re
-            json_match = re.search(r'\[.*\]', result, re.DOTALL)
-            if json_match:
-                parsed = json.loads(json_match.group())
-                # Same validation
-                if parsed and len(parsed) > 0:
-                    first_table = parsed[0]
-                    if first_table.get('rows'):
-                        first_row = first_table['rows'][0]
-                        row_str = json.dumps(first_row).lower()
-                        sample_patterns = ['Product A', 'Product B', 'Product C', 'Sample', 'Example', 'Test']
-                        if any(pattern.lower() in row_str for pattern in sample_patterns):
-                            return []
-                return parsed
-        except Exception as e:
-            print(f"Error parsing tables: {e}")
-            pass
+        result = self._tables_chain.invoke({"context": trim_text(content, CONTEXT_TOKENS, CONTEXT_CHARS)})
+        self._tables_cache[key] = self._parse_tables(result)
+        return self._tables_cache[key]
+    
+    def _parse_tables(self, result: str) -> List[Dict[str, Any]]:
+        """Parse the tables JSON object, rejecting LLM-invented sample data"""
+        parsed = _parse_json(result, "tables")
+        tables = parsed.get("tables", []) if isinstance(parsed, dict) else parsed
+        if not isinstance(tables, list):
+            return []
         
-        return []
+        # Validate that it's not sample data
+        if _is_sample_data(tables):
+            return []
+        return tables
+    
+    @staticmethod
+    def _regex_prefill(content: str) -> Dict[str, Any]:
+        """Read fixed-format invoice fields with regex so the LLM only fills the gaps.
+        
+        A field is accepted only when the document yields a single distinct
+        candidate for it; conflicting candidates are left to the LLM.
+        """
+        def confident(matches):
+            distinct = list(dict.fromkeys(m.strip() for m in matches))
+            if len(distinct) == 1:
+                return distinct[0]
+            return None
+        
+        fields = {
+            "invoiceNumber": confident(_INVOICE_NO_RE.findall(content)),
+            "invoiceDate": confident(_INVOICE_DATE_RE.findall(content)),
+            "dueDate": confident(_DUE_DATE_RE.findall(content)),
+            "currency": confident(_CURRENCY_RE.findall(content)),
+        }
+        bank = {
+            "ifscCode": confident(_IFSC_RE.findall(content)),
+            "swiftCode": confident(_SWIFT_RE.findall(content)),
+        }
+        return {
+            "fields": {k: v for k, v in fields.items() if v},
+            "bankDetails": {k: v for k, v in bank.items() if v},
+            # Which party a GSTIN or PAN belongs to needs the layout, so these are hints only
+            "gstNumbers": list(dict.fromkeys(_GSTIN_RE.findall(content))),
+            "panNumbers": list(dict.fromkeys(_PAN_RE.findall(content)))
+        }
     
     def analyze_invoice_detailed(self, retriever) -> Dict[str, Any]:
         """Comprehensive detailed invoice analysis with accurate extraction and calculation verification"""
-        def format_docs(docs):
-            return "\n\n".join(doc.page_content for doc in docs)
-        
         # Self-contained extraction
         content, docs = self._extract_invoice_content(retriever)
         
         # Final check - be more lenient with minimum content
         if not content or len(content.strip()) < 20:
-            error_msg = "Could not extract sufficient content from the invoice PDF. "
-            error_msg += "Possible reasons: "
-            error_msg += "1) The PDF might be image-based/scanned (requires OCR), "
-            error_msg += "2) The PDF might be corrupted, "
-            error_msg += "3) The PDF might not contain selectable text. "
-            error_msg += "Please ensure the PDF contains selectable text or try converting it to a text-based PDF."
+            error_msg = (
+                "Could not extract sufficient content from the invoice PDF. "
+                "Possible reasons: "
+                "1) The PDF might be image-based/scanned (requires OCR), "
+                "2) The PDF might be corrupted, "
+                "3) The PDF might not contain selectable text. "
+                "Please ensure the PDF contains selectable text or try converting it to a text-based PDF."
+            )
             print(f"ERROR: Invoice extraction failed. Content length: {len(content) if content else 0} characters")
             print(f"Number of docs retrieved: {len(docs) if docs else 0}")
             return {
@@ -231,90 +624,54 @@ Return ONLY valid JSON array, no additional text.
         # Log content length for debugging
         print(f"Invoice content extracted: {len(content)} characters from {len(docs) if docs else 0} document chunks")
         
-        # Single comprehensive extraction to ensure consistency
-        comprehensive_template = """Extract ALL data from this invoice accurately. Extract EXACT values from the document - do NOT create sample or example data.
-
-Invoice Document: {{context}}
-
-Extract and return a JSON object with:
-- invoiceNumber: exact invoice number from document
-- invoiceDate: exact date from document
-- dueDate: exact due date from document
-- vendorName: exact vendor/seller name from document
-- vendorAddress: exact vendor address from document
-- vendorGST: GST number if present
-- vendorPAN: PAN number if present
-- buyerName: exact buyer/recipient name from document
-- buyerAddress: exact buyer address from document
-- buyerGST: GST number if present
-- buyerPAN: PAN number if present
-- subtotal: subtotal amount as number (remove currency symbols)
-- taxBreakdown: array of tax objects, each with taxType (e.g., "CGST", "SGST", "IGST", "GST"), taxRate (as number), taxAmount (as number), taxableAmount (as number)
-- discount: discount amount as number (0 if not present)
-- shippingCharges: shipping amount as number (0 if not present)
-- totalAmount: total amount as number from document
-- currency: currency code (e.g., "USD", "INR", "₹", "$")
-- paymentTerms: exact payment terms from document
-- paymentMethod: payment method if mentioned
-- paymentTransactionID: transaction ID if present
-- lineItems: array of line item objects, each with itemNumber, description, quantity (as number), unitPrice (as number), totalPrice (as number), taxRate (as number), taxAmount (as number), category
-- lineItemsCount: total number of line items
-- lineItemsTotal: sum of all line item totalPrice values
-
-IMPORTANT:
-- Extract ONLY actual values from the document
-- Use exact names, dates, and amounts as they appear
-- Convert amounts to numbers (remove currency symbols and commas)
-- Verify calculations: subtotal + sum of all taxes - discount + shipping = totalAmount
-- If calculations don't match, note it in calculationErrors
-
-Return ONLY valid JSON, no additional text.
-"""
-        
-        # Replace double braces with single for context variable
-        formatted_template = comprehensive_template.replace("{{context}}", "{context}")
-        
-        try:
-            prompt = PromptTemplate.from_template(formatted_template)
-        except Exception as e:
-            print(f"ERROR: Failed to create prompt template: {e}")
-            return {
-                "documentType": "Invoice",
-                "error": f"Template processing error: {str(e)}",
-                "summary": "",
-                "financialDetails": {},
-                "lineItemsAnalysis": {},
-                "paymentAnalysis": {},
-                "riskAnalysis": {},
-                "tables": []
-            }
+        # Truncate once so every analysis below sees the same context window
+        ctx = trim_text(str(content), CONTEXT_TOKENS, CONTEXT_CHARS)
         
-        chain = prompt | self.llm | self.output_parser
+        risk_info = {"risks": [], "complianceIssues": [], "missingInformation": [], "duplicateCharges": [], "suspiciousPatterns": []}
+        payment_info = {}
         
         try:
-            # Ensure content is a string and not empty
-            content_str = str(content) if content else ""
-            if not content_str.strip():
-                raise ValueError("Content is empty")
+            prefill = self._regex_prefill(ctx)
+            known_fields = dict(prefill["fields"])
+            if prefill["gstNumbers"]:
+                known_fields["gstNumbersInDocument"] = prefill["gstNumbers"]
+            if prefill["panNumbers"]:
+                known_fields["panNumbersInDocument"] = prefill["panNumbers"]
             
-            comprehensive_data = chain.invoke({"context": content_str[:10000]})
+            comprehensive_data = self._invoice_chain.invoke({
+                "context": ctx,
+                "known_fields": json.dumps(known_fields) if known_fields else "none"
+            })
             
             # Parse comprehensive result
-            if comprehensive_data.strip().startswith('{'):
-                extracted_data = json.loads(comprehensive_data)
-            else:
-                json_match = re.search(r'\{.*\}', comprehensive_data, re.DOTALL)
-                if json_match:
-                    extracted_data = json.loads(json_match.group())
-                else:
-                    extracted_data = {}
+            combined = _parse_json(comprehensive_data, "invoice") or {}
+            
+            # Tolerate a flat reply that skipped the extractedData wrapper
+            extracted_data = combined.get("extractedData", combined) if isinstance(combined, dict) else {}
+            if not isinstance(extracted_data, dict):
+                extracted_data = {}
+            # Sections of the wrong shape keep their defaults; both are written to below
+            if isinstance(combined, dict) and isinstance(combined.get("riskAnalysis"), dict):
+                risk_info = combined["riskAnalysis"] or risk_info
+            if isinstance(combined, dict) and isinstance(combined.get("paymentAnalysis"), dict):
+                payment_info = combined["paymentAnalysis"] or payment_info
+            
+            # Deterministic regex hits take precedence over the model's reading
+            extracted_data.update(prefill["fields"])
+            if prefill["bankDetails"]:
+                bank_details = payment_info.get("bankDetails")
+                if not isinstance(bank_details, dict):
+                    bank_details = {}
+                payment_info["bankDetails"] = {**bank_details, **prefill["bankDetails"]}
             
             # Verify calculations
             calculation_errors = []
             subtotal = extracted_data.get("subtotal", 0) or 0
             discount = extracted_data.get("discount", 0) or 0
             shipping = extracted_data.get("shippingCharges", 0) or 0
-            total_tax = sum(tax.get("taxAmount", 0) or 0 for tax in extracted_data.get("taxBreakdown", []))
+            # Summed once; the summary below reuses the same figure
+            tax_breakdown = extracted_data.get("taxBreakdown") or []
+            total_tax = sum(tax.get("taxAmount", 0) or 0 for tax in tax_breakdown)
             stated_total = extracted_data.get("totalAmount", 0) or 0
             
             calculated_total = subtotal + total_tax - discount + shipping
@@ -326,8 +683,22 @@ Return ONLY valid JSON, no additional text.
                 })
             
             # Verify line items total
+            # One pass over the line items: total, category counts and highest/lowest items,
+            # converting each totalPrice once
             line_items = extracted_data.get("lineItems", [])
-            line_items_total = sum(float(item.get("totalPrice", 0) or 0) for item in line_items)
+            line_items_total = 0.0
+            categories = {}
+            highest = lowest = None
+            highest_value = lowest_value = 0.0
+            for item in line_items:
+                price = float(item.get("totalPrice", 0) or 0)
+                line_items_total += price
+                category = item.get("category", "Uncategorized")
+                categories[category] = categories.get(category, 0) + 1
+                if highest is None or price > highest_value:
+                    highest_value, highest = price, item
+                if lowest is None or price < lowest_value:
+                    lowest_value, lowest = price, item
             if line_items and abs(line_items_total - subtotal) > 0.01:
                 calculation_errors.append({
                     "title": "Line Items Total Mismatch",
@@ -348,7 +719,7 @@ Return ONLY valid JSON, no additional text.
                 "buyerGST": extracted_data.get("buyerGST"),
                 "buyerPAN": extracted_data.get("buyerPAN"),
                 "subtotal": subtotal,
-                "taxBreakdown": extracted_data.get("taxBreakdown", []),
+                "taxBreakdown": tax_breakdown,
                 "discount": discount,
                 "shippingCharges": shipping,
                 "totalAmount": stated_total,
@@ -365,23 +736,14 @@ Return ONLY valid JSON, no additional text.
                 "lineItems": line_items,
                 "lineItemsSummary": {
                     "totalItems": len(line_items),
-                    "categories": {},
+                    "categories": categories,
                     "averageItemValue": line_items_total / len(line_items) if line_items else 0,
                     "highestValueItem": None,
                     "lowestValueItem": None
                 }
             }
             
-            # Calculate categories and find highest/lowest
             if line_items:
-                for item in line_items:
-                    category = item.get("category", "Uncategorized")
-                    line_items_info["lineItemsSummary"]["categories"][category] = line_items_info["lineItemsSummary"]["categories"].get(category, 0) + 1
-                
-                # Find highest and lowest value items
-                highest = max(line_items, key=lambda x: float(x.get("totalPrice", 0) or 0))
-                lowest = min(line_items, key=lambda x: float(x.get("totalPrice", 0) or 0))
-                
                 line_items_info["lineItemsSummary"]["highestValueItem"] = {
                     "description": highest.get("description", ""),
                     "totalPrice": highest.get("totalPrice", 0)
@@ -396,103 +758,12 @@ Return ONLY valid JSON, no additional text.
             import traceback
             traceback.print_exc()
             financial_info = {}
+            total_tax = 0
             line_items_info = {"lineItems": [], "lineItemsSummary": {}}
             calculation_errors = [{"title": "Extraction Error", "message": str(e)}]
         
-        # 2. Risk and compliance analysis using extracted data
-        risk_template = """Perform a comprehensive risk and compliance analysis of this invoice using the extracted data.
-
-Invoice Document: {{context}}
-
-Extracted Financial Data:
-- Vendor: {vendor_name}
-- Buyer: {buyer_name}
-- Total Amount: {currency} {total_amount}
-- Subtotal: {currency} {subtotal}
-- Taxes: {currency} {total_tax}
-- Discount: {currency} {discount}
-- Shipping: {currency} {shipping}
-- Line Items Count: {line_items_count}
-
-Return a JSON object with: risks (array of risk objects with title, description, severity, category, evidence, impact, recommendation, affectedAmount), complianceIssues (array), missingInformation (array), duplicateCharges (array), suspiciousPatterns (array).
-
-Each risk object should have: title, description (3-5 sentences), severity (high/medium/low), category, evidence, impact, recommendation, affectedAmount.
-
-Return ONLY valid JSON, no additional text.
-"""
-            
-        formatted_risk_template = risk_template.replace("{{context}}", "{context}").format(
-            vendor_name=financial_info.get("vendorName", "Unknown"),
-            buyer_name=financial_info.get("buyerName", "Unknown"),
-            currency=financial_info.get("currency", ""),
-            total_amount=financial_info.get("totalAmount", 0),
-            subtotal=financial_info.get("subtotal", 0),
-            total_tax=sum(tax.get("taxAmount", 0) or 0 for tax in financial_info.get("taxBreakdown", [])),
-            discount=financial_info.get("discount", 0),
-            shipping=financial_info.get("shippingCharges", 0),
-            line_items_count=line_items_info.get("lineItemsSummary", {}).get("totalItems", 0)
-        )
-        
-        try:
-            prompt = PromptTemplate.from_template(formatted_risk_template)
-            chain = prompt | self.llm | self.output_parser
-            content_str = str(content) if content else ""
-            risk_data = chain.invoke({"context": content_str[:8000]})
-        except Exception as e:
-            print(f"ERROR in risk analysis: {e}")
-            risk_data = "{}"
-        
-        risk_info = {"risks": [], "complianceIssues": [], "missingInformation": [], "duplicateCharges": [], "suspiciousPatterns": []}
-        try:
-            if risk_data.strip().startswith('{'):
-                risk_info = json.loads(risk_data)
-            else:
-                json_match = re.search(r'\{.*\}', risk_data, re.DOTALL)
-                if json_match:
-                    risk_info = json.loads(json_match.group())
-        except Exception as e:
-            print(f"Error parsing risk data: {e}")
-        
         # Add calculation errors to risk info
         risk_info["calculationErrors"] = calculation_errors
-    
-        # 3. Payment and terms analysis using extracted data
-        payment_template = """Analyze payment terms and payment-related information from this invoice.
-
-Invoice Document: {{context}}
-
-Extracted Data:
-- Payment Terms: {payment_terms}
-- Due Date: {due_date}
-- Payment Method: {payment_method}
-- Transaction ID: {transaction_id}
-
-Return a JSON object with: paymentTerms (object with terms, dueDate, daysUntilDue, earlyPaymentDiscount, latePaymentPenalty, paymentMethods), paymentStatus, bankDetails (object with accountNumber, bankName, ifscCode, swiftCode if found in document), recommendations (array).
-
-Return ONLY valid JSON, no additional text.
-"""
-            
-        formatted_payment_template = payment_template.replace("{{context}}", "{context}").format(
-            payment_terms=financial_info.get("paymentTerms", ""),
-            due_date=financial_info.get("dueDate", ""),
-            payment_method=financial_info.get("paymentMethod", ""),
-            transaction_id=financial_info.get("paymentTransactionID", "")
-        )
-        
-        prompt = PromptTemplate.from_template(formatted_payment_template)
-        chain = prompt | self.llm | self.output_parser
-        payment_data = chain.invoke({"context": content[:8000]})
-        
-        payment_info = {}
-        try:
-            if payment_data.strip().startswith('{'):
-                payment_info = json.loads(payment_data)
-            else:
-                json_match = re.search(r'\{.*\}', payment_data, re.DOTALL)
-                if json_match:
-                    payment_info = json.loads(json_match.group())
-        except Exception as e:
-            print(f"Error parsing payment data: {e}")
         
         # 4. Create accurate summary using extracted data
         vendor_name = financial_info.get("vendorName", "Unknown Vendor")
@@ -503,34 +774,47 @@ Return ONLY valid JSON, no additional text.
         currency = financial_info.get("currency", "")
         total = financial_info.get("totalAmount", 0)
         subtotal = financial_info.get("subtotal", 0)
-        total_tax = sum(tax.get("taxAmount", 0) or 0 for tax in financial_info.get("taxBreakdown", []))
         discount = financial_info.get("discount", 0)
         shipping = financial_info.get("shippingCharges", 0)
         line_items_count = line_items_info.get("lineItemsSummary", {}).get("totalItems", 0)
         payment_terms = financial_info.get("paymentTerms", "Not specified")
         
-        detailed_summary = f"This invoice is from {vendor_name} to {buyer_name}, with invoice number {invoice_num}, dated {invoice_date}, and due on {due_date}. "
-        detailed_summary += f"The total amount is {currency} {total}. "
-        detailed_summary += f"The breakdown includes a subtotal of {currency} {subtotal}, "
+        summary_parts = [
+            f"This invoice is from {vendor_name} to {buyer_name}, with invoice number {invoice_num}, dated {invoice_date}, and due on {due_date}. ",
+            f"The total amount is {currency} {total}. ",
+            f"The breakdown includes a subtotal of {currency} {subtotal}, ",
+        ]
         if total_tax > 0:
-            detailed_summary += f"taxes totaling {currency} {total_tax}, "
+            summary_parts.append(f"taxes totaling {currency} {total_tax}, ")
         if discount > 0:
-            detailed_summary += f"a discount of {currency} {discount}, "
+            summary_parts.append(f"a discount of {currency} {discount}, ")
         if shipping > 0:
-            detailed_summary += f"and shipping charges of {currency} {shipping}. "
-        detailed_summary += f"The invoice contains {line_items_count} line item(s). "
-        detailed_summary += f"Payment terms are: {payment_terms}. "
+            summary_parts.append(f"and shipping charges of {currency} {shipping}. ")
+        summary_parts.append(f"The invoice contains {line_items_count} line item(s). ")
+        summary_parts.append(f"Payment terms are: {payment_terms}. ")
         
         if financial_info.get("vendorGST") or financial_info.get("vendorPAN"):
-            detailed_summary += f"Vendor GST: {financial_info.get('vendorGST', 'N/A')}, PAN: {financial_info.get('vendorPAN', 'N/A')}. "
+            summary_parts.append(f"Vendor GST: {financial_info.get('vendorGST', 'N/A')}, PAN: {financial_info.get('vendorPAN', 'N/A')}. ")
         if financial_info.get("buyerGST") or financial_info.get("buyerPAN"):
-            detailed_summary += f"Buyer GST: {financial_info.get('buyerGST', 'N/A')}, PAN: {financial_info.get('buyerPAN', 'N/A')}. "
+            summary_parts.append(f"Buyer GST: {financial_info.get('buyerGST', 'N/A')}, PAN: {financial_info.get('buyerPAN', 'N/A')}. ")
         
         if calculation_errors:
-            detailed_summary += f"Note: {len(calculation_errors)} calculation discrepancy(ies) detected. Please verify the invoice totals carefully."
-        
-        # Extract tables
-        tables = self.extract_tables(retriever)
+            summary_parts.append(f"Note: {len(calculation_errors)} calculation discrepancy(ies) detected. Please verify the invoice totals carefully.")
+        
+        detailed_summary = "".join(summary_parts)
+        
+        # The combined call already returned the line items; only ask for tables without them
+        line_items = line_items_info.get("lineItems") or []
+        if line_items and isinstance(line_items[0], dict):
+            tables = [{
+                "tableName": "Line Items",
+                "headers": list(line_items[0].keys()),
+                "rows": line_items,
+                "totalAmount": total,
+                "currency": currency
+            }]
+        else:
+            tables = self.extract_tables(retriever, ctx)
         
         # Combine all information
         return {
@@ -540,65 +824,96 @@ Return ONLY valid JSON, no additional text.
             "lineItemsAnalysis": line_items_info,
             "paymentAnalysis": payment_info,
             "riskAnalysis": risk_info,
-            "tables": tables,
-            "risks": risk_info.get("risks", []),
-            "complianceIssues": risk_info.get("complianceIssues", []),
-            "calculationErrors": risk_info.get("calculationErrors", []),
-            "missingInformation": risk_info.get("missingInformation", []),
-            "duplicateCharges": risk_info.get("duplicateCharges", []),
-            "suspiciousPatterns": risk_info.get("suspiciousPatterns", [])
+            "tables": tables
         }
     
-    def analyze_business_doc(self, retriever) -> Dict[str, Any]:
+    def analyze_business_doc(self, retriever, hint: Optional[str] = None) -> Dict[str, Any]:
         """Comprehensive business document analysis"""
+        return self.batch_analyze([retriever], [hint])[0]
+    
+    def batch_analyze(self, retrievers: List, hints: Optional[List[Optional[str]]] = None) -> List[Dict[str, Any]]:
+        """Analyze several documents, sending each stage's LLM calls as one batch"""
+        config = {"max_concurrency": 20}
+        
+        # Stage 1: document types - caller hints, then phrase rules, then embeddings,
+        # and the LLM only for the ambiguous ones
+        for retriever, hint in zip(retrievers, hints or []):
+            doc_type = self._hint_type(hint)
+            if doc_type and id(retriever) not in self._doc_type_cache:
+                self._doc_type_cache[id(retriever)] = doc_type
+        pending = [r for r in retrievers if id(r) not in self._doc_type_cache]
+        if pending:
+            inputs = [self._type_input(r) for r in pending]
+            labels = [self._rule_classify(i["context"]) for i in inputs]
+            todo = [n for n, label in enumerate(labels) if not label]
+            if todo:
+                for n, label in zip(todo, self._embed_classify([inputs[n]["context"] for n in todo])):
+                    labels[n] = label
+            unresolved = []
+            for retriever, inp, label in zip(pending, inputs, labels):
+                if label:
+                    self._doc_type_cache[id(retriever)] = label
+                else:
+                    unresolved.append((retriever, inp))
+            if unresolved:
+                results = self._type_chain.batch([inp for _, inp in unresolved], config=config)
+                for (retriever, _), result in zip(unresolved, results):
+                    self._doc_type_cache[id(retriever)] = self._classify_doc_type(result)
+        
+        # Stage 2: tables (invoices extract theirs alongside the detailed analysis)
+        pending = []
+        for retriever in retrievers:
+            if self._doc_type_cache[id(retriever)] == "Invoice" or id(retriever) in self._tables_cache:
+                continue
+            content = self._get_context(retriever)
+            if not content or len(content.strip()) < 50:
+                self._tables_cache[id(retriever)] = []
+            else:
+                pending.append((retriever, content))
+        if pending:
+            results = self._tables_chain.batch([{"context": trim_text(c, CONTEXT_TOKENS, CONTEXT_CHARS)} for _, c in pending], config=config)
+            for (retriever, _), result in zip(pending, results):
+                self._tables_cache[id(retriever)] = self._parse_tables(result)
+        
+        # Stage 3: contract negotiation points
+        contracts = [r for r in retrievers if self._doc_type_cache[id(r)] == "Contract"]
+        negotiation = {}
+        if contracts:
+            inputs = [{"context": self._get_context(r)[:5000]} for r in contracts]
+            results = self._negotiation_chain.batch(inputs, config=config)
+            for retriever, result in zip(contracts, results):
+                negotiation[id(retriever)] = _parse_json(result, "negotiation points") or []
+        
+        if len(retrievers) == 1:
+            return [self._analyze_one(retrievers[0], negotiation.get(id(retrievers[0]), []))]
+        
+        # Per-document pipelines are independent and I/O-bound, so run them side by side
+        with ThreadPoolExecutor(max_workers=min(8, len(retrievers))) as pool:
+            futures = [pool.submit(self._analyze_one, r, negotiation.get(id(r), [])) for r in retrievers]
+        return [f.result() for f in futures]
+    
+    def _analyze_one(self, retriever, negotiation_points) -> Dict[str, Any]:
+        """Assemble one document's analysis once the batched stages have run"""
         doc_type = self.detect_document_type(retriever)
         
         # Use detailed invoice analysis for invoices
         if doc_type == "Invoice":
             return self.analyze_invoice_detailed(retriever)
         
-        tables = self.extract_tables(retriever)
-        insights = self.workflow.extract_insights(retriever, doc_type.lower())
-        risk_analysis = self.workflow.produce_risk_analysis(retriever)
-        action_items = self.workflow.generate_action_items(retriever)
-        
-        # Extract negotiation points for contracts
-        negotiation_points = []
-        if doc_type == "Contract":
-            template = """Identify negotiation points and key terms in this contract.
-            
-Contract: {context}
-            
-Return a JSON object with:
-- keyTerms: [list of important terms]
-- negotiationPoints: [list of points that could be negotiated]
-- redFlags: [list of concerning clauses]
-- favorableTerms: [list of favorable terms]
-
-Return ONLY valid JSON, no additional text.
-"""
-            
-            def format_docs(docs):
-                return "\n\n".join(doc.page_content for doc in docs)
-            
-            docs = retriever.get_relevant_documents("contract") if hasattr(retriever, 'get_relevant_documents') else []
-            content = format_docs(docs) if docs else ""
-            
-            prompt = PromptTemplate.from_template(template)
-            chain = prompt | self.llm | self.output_parser
-            
-            result = chain.invoke({"context": content[:5000]})
-            
-            try:
-                if result.strip().startswith('{'):
-                    negotiation_points = json.loads(result)
-                else:
-                    import re
-                    json_match = re.search(r'\{.*\}', result, re.DOTALL)
-                    if json_match:
-                        negotiation_points = json.loads(json_match.group())
-            except:
-                pass
+        # Retrieve once and hand the text to every workflow call instead of letting
+        # each one run its own vector search
+        content = self._get_context(retriever)
+        
+        # Independent, I/O-bound calls; WorkflowProcessor is sync-only, so use threads
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            tables_future = pool.submit(self.extract_tables, retriever, content)
+            insights_future = pool.submit(self.workflow.extract_insights, retriever, doc_type.lower(), content)
+            risk_future = pool.submit(self.workflow.produce_risk_analysis, retriever, content)
+            actions_future = pool.submit(self.workflow.generate_action_items, retriever, content)
+        tables = tables_future.result()
+        insights = insights_future.result()
+        risk_analysis = risk_future.result()
+        action_items = actions_future.result()
         
         return {
             "documentType": doc_type,
@@ -606,7 +921,6 @@ Return ONLY valid JSON, no additional text.
             "tables": tables,
             "insights": insights,
             "risks": risk_analysis.get("risks", []),
-            "redFlags": risk_analysis.get("risks", []),
             "actionItems": action_items,
             "negotiationPoints": negotiation_points.get("negotiationPoints", []) if negotiation_points else [],
             "keyTerms": negotiation_points.get("keyTerms", []) if negotiation_points else []
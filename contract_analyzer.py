@@ -3,151 +3,195 @@ Professional Contract Analyzer Module
 Analyzes contracts for legal compliance, risks, obligations, and missing clauses.
 """
 
+import copy
+import hashlib
 import json
+import os
 import re
-from typing import Dict, Any, List
+import threading
+import time
+import weakref
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+import numpy as np
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
-
-# No external dependencies - self-contained extraction
-
-
-class ContractAnalyzer:
-    """Professional contract analysis system"""
-    
-    def __init__(self, openai_api_key: str):
-        from langchain_openai import ChatOpenAI
-        # Use faster model with optimized settings for comprehensive analysis
-        self.llm = ChatOpenAI(
-            model="gpt-4o-mini", 
-            temperature=0.1, 
-            openai_api_key=openai_api_key,
-            max_tokens=6000,  # Increased for comprehensive clause analysis
-            timeout=90  # 90 second timeout for comprehensive analysis
-        )
-        self.output_parser = StrOutputParser()
-    
-    def _create_chain(self, template: str, retriever):
-        """Create LangChain chain for document analysis"""
-        def format_docs(docs):
-            return "\n\n".join(doc.page_content for doc in docs)
-        
-        def get_context(query):
-            docs = retriever.get_relevant_documents(query) if hasattr(retriever, 'get_relevant_documents') else []
-            return format_docs(docs) if docs else ""
-        
-        prompt = PromptTemplate.from_template(template)
-        chain = (
-            {"context": RunnablePassthrough() | get_context}
-            | prompt
-            | self.llm
-            | self.output_parser
-        )
-        return chain
-    
-    def _extract_contract_content(self, retriever):
-        """Extract contract content with multiple fallback strategies - self-contained"""
-        def format_docs(docs):
-            return "\n\n".join(doc.page_content for doc in docs)
-        
-        content = ""
-        docs = []
-        
-        # Strategy 1: Search for contract-specific terms
-        if hasattr(retriever, 'get_relevant_documents'):
-            search_queries = [
-                "contract agreement parties obligations terms conditions",
-                "contract",
-                "agreement",
-                "parties obligations"
-            ]
-            for query in search_queries:
-                try:
-                    temp_docs = retriever.get_relevant_documents(query)
-                    if temp_docs:
-                        temp_content = format_docs(temp_docs)
-                        if len(temp_content.strip()) > len(content.strip()):
-                            content = temp_content
-                            docs = temp_docs
-                except:
-                    continue
-        
-        # Strategy 2: Broader search
-        if len(content.strip()) < 200:
-            broad_queries = ["document", "text", "content", ""]
-            for query in broad_queries:
-                try:
-                    if hasattr(retriever, 'get_relevant_documents'):
-                        temp_docs = retriever.get_relevant_documents(query)
-                        if temp_docs:
-                            temp_content = format_docs(temp_docs)
-                            if len(temp_content.strip()) > len(content.strip()):
-                                content = temp_content
-                                docs = temp_docs
-                except:
-                    continue
-        
-        # Strategy 3: Direct vectorstore access
-        if len(content.strip()) < 200:
-            try:
-                vectorstore = None
-                if hasattr(retriever, 'vectorstore'):
-                    vectorstore = retriever.vectorstore
-                elif hasattr(retriever, '_vectorstore'):
-                    vectorstore = retriever._vectorstore
-                
-                if vectorstore:
-                    try:
-                        all_docs = vectorstore.similarity_search("", k=200)
-                        if all_docs:
-                            temp_content = format_docs(all_docs)
-                            if len(temp_content.strip()) > len(content.strip()):
-                                content = temp_content
-                                docs = all_docs
-                    except:
-                        pass
-            except:
-                pass
-        
-        return content, docs
-    
-    def analyze_contract(self, retriever) -> Dict[str, Any]:
-        """Comprehensive international contract analysis - globally neutral approach"""
-        
-        # Self-contained extraction
-        content, docs = self._extract_contract_content(retriever)
-        
-        # Final check - be more lenient
-        if not content or len(content.strip()) < 20:
-            error_msg = "Could not extract sufficient content from the contract PDF. "
-            error_msg += "Possible reasons: "
-            error_msg += "1) The PDF might be image-based/scanned (requires OCR), "
-            error_msg += "2) The PDF might be corrupted, "
-            error_msg += "3) The PDF might not contain selectable text. "
-            error_msg += "Please ensure the PDF contains selectable text or try converting it to a text-based PDF."
-            print(f"ERROR: Contract extraction failed. Content length: {len(content) if content else 0} characters")
-            print(f"Number of docs retrieved: {len(docs) if docs else 0}")
-            return {
-                "error": error_msg,
-                "executiveSummary": [],
-                "partiesAndType": {},
-                "scopeAndObligations": {},
-                "commercialTerms": {},
-                "clauseAnalysis": [],
-                "riskAssessment": [],
-                "globalCompliance": {},
-                "optionalImprovements": []
-            }
-        
-        print(f"Contract content extracted: {len(content)} characters from {len(docs) if docs else 0} document chunks")
-        
-        # Comprehensive international contract analysis
-        comprehensive_template = """You are a senior international contracts lawyer and enterprise project governance expert.
+from llm_utils import extract_json_span, http_client, loads, stored_docs, trim_text
+
+# Prompt context budgets, in tokens when tiktoken is available and characters otherwise
+# (the character figures are the original slices, ~4 characters per token)
+COMPREHENSIVE_TOKENS, COMPREHENSIVE_CHARS = 3750, 15000
+ASPECT_TOKENS, ASPECT_CHARS = 1250, 5000
+
+
+# Process-wide LRU of retrieval results keyed by (id(retriever), query). Analyzers are
+# built per request, so re-analyzing the active document would otherwise repeat every
+# vector search. Each entry holds a weak reference so a recycled id() never matches
+_RETRIEVAL_CACHE_SIZE = 256
+_retrieval_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+_retrieval_cache_lock = threading.Lock()
+
+# Query embeddings keyed by (embedding model, query). The query strings are a fixed set,
+# so a new upload only pays for its vector searches, not for re-embedding the queries
+_QUERY_VECTOR_CACHE_SIZE = 512
+_query_vectors: "OrderedDict[tuple, List[float]]" = OrderedDict()
+_query_vectors_lock = threading.Lock()
+
+
+def _query_vector(embeddings, query: str) -> List[float]:
+    key = (type(embeddings).__name__, getattr(embeddings, 'model', None), query)
+    with _query_vectors_lock:
+        vector = _query_vectors.get(key)
+        if vector is not None:
+            _query_vectors.move_to_end(key)
+            return vector
+    vector = embeddings.embed_query(query)
+    with _query_vectors_lock:
+        _query_vectors[key] = vector
+        while len(_query_vectors) > _QUERY_VECTOR_CACHE_SIZE:
+            _query_vectors.popitem(last=False)
+    return vector
+
+
+def _search(retriever, query: str) -> List:
+    """Similarity search with a memoized query embedding, or the retriever's own path
+    when it isn't a plain vector-store similarity retriever"""
+    vectorstore = getattr(retriever, 'vectorstore', None)
+    embeddings = getattr(vectorstore, 'embeddings', None)
+    if (not query or embeddings is None
+            or getattr(retriever, 'search_type', 'similarity') != 'similarity'
+            or not hasattr(vectorstore, 'similarity_search_by_vector')):
+        return retriever.get_relevant_documents(query)
+    search_kwargs = dict(getattr(retriever, 'search_kwargs', None) or {})
+    k = search_kwargs.pop('k', 4)
+    return vectorstore.similarity_search_by_vector(_query_vector(embeddings, query), k=k, **search_kwargs)
+
+
+def _retrieve(retriever, query: str) -> List:
+    key = (id(retriever), query)
+    with _retrieval_cache_lock:
+        entry = _retrieval_cache.get(key)
+        if entry is not None and entry[0]() is retriever:
+            _retrieval_cache.move_to_end(key)
+            return entry[1]
+    docs = _search(retriever, query)
+    try:
+        ref = weakref.ref(retriever)
+    except TypeError:  # not weak-referenceable; don't risk caching under a reusable id
+        return docs
+    with _retrieval_cache_lock:
+        _retrieval_cache[key] = (ref, docs)
+        _retrieval_cache.move_to_end(key)
+        while len(_retrieval_cache) > _RETRIEVAL_CACHE_SIZE:
+            _retrieval_cache.popitem(last=False)
+    return docs
+
+
+def _format_docs(docs) -> str:
+    return "\n\n".join([doc.page_content for doc in docs])
+
+
+def _parse_json_lenient(result: str, opener: str = '{') -> Any:
+    """Parse a model reply as JSON, salvaging the first balanced object/array from
+    surrounding text; None if nothing parseable is found"""
+    text = result.strip()
+    if text.startswith(opener):
+        try:
+            return loads(text)
+        except ValueError:  # json.JSONDecodeError and orjson.JSONDecodeError
+            pass
+    json_span = extract_json_span(text, opener)
+    if json_span is None:
+        return None
+    try:
+        return loads(json_span)
+    except ValueError:
+        return None
+
+
+# Fixed-format metadata read with regex before the metadata prompt. Dates are only
+# taken in ISO form since that is the format the prompt asks for
+_ISO_DATE = r'((?:19|20)\d{2}[-/](?:0[1-9]|1[0-2])[-/](?:0[1-9]|[12]\d|3[01]))\b'
+_CONTRACT_DATE_RE = re.compile(r'(?i:dated(?:\s+as\s+of)?|entered\s+into\s+(?:as\s+of|on)|made\s+(?:as\s+of|on))\s*[:\-]?\s*' + _ISO_DATE)
+_EFFECTIVE_DATE_RE = re.compile(r'(?i:effective\s+(?:date|as\s+of|from|on))\s*[:\-]?\s*' + _ISO_DATE)
+_EXPIRATION_DATE_RE = re.compile(r'(?i:(?:expir\w*|terminat\w*|end)\s+(?:date|on))\s*[:\-]?\s*' + _ISO_DATE)
+_CONTRACT_VALUE_RE = re.compile(
+    r'(?i:contract\s+(?:value|price|sum)|total\s+(?:fees?|consideration|contract\s+value))\D{0,20}?'
+    r'((?:USD|EUR|GBP|INR|AUD|CAD|SGD|\$|€|£|₹)\s?\d[\d,]*(?:\.\d{2})?)'
+)
+_GOVERNING_LAW_RE = re.compile(r'(?i:governed\s+by)\s.{0,80}?(?i:laws?\s+of)\s+(?:the\s+)?([A-Z][A-Za-z]+(?:\s+(?:of\s+|and\s+)?[A-Z][A-Za-z]+)*)')
+_METADATA_PATTERNS = (
+    ("contractDate", _CONTRACT_DATE_RE),
+    ("effectiveDate", _EFFECTIVE_DATE_RE),
+    ("expirationDate", _EXPIRATION_DATE_RE),
+    ("contractValue", _CONTRACT_VALUE_RE),
+    ("governingLaw", _GOVERNING_LAW_RE),
+)
+
+
+def _regex_metadata(content: str) -> Dict[str, str]:
+    """Metadata fields the text states unambiguously; a field with conflicting matches is left to the LLM"""
+    found = {}
+    for field, pattern in _METADATA_PATTERNS:
+        distinct = list(dict.fromkeys(m.strip().replace("/", "-") if "Date" in field else m.strip() for m in pattern.findall(content)))
+        if len(distinct) == 1:
+            found[field] = distinct[0]
+    return found
+
+
+# First-pass retrieval for the comprehensive analysis
+CONTRACT_QUERY = "contract agreement document parties obligations terms conditions"
+
+# One retrieval serves every aspect prompt; the query is the union of the terms the
+# aspects used to search for separately
+ASPECT_QUERY = "contract parties dates value obligations responsibilities duties risks liabilities termination payment clauses terms conditions IP dispute"
+
+# Per-aspect prompts: name -> (reply shape, default). "{" is a JSON object, "[" a list
+# the prompt wraps as {"items": [...]} so it can use JSON mode, None is prose
+_ASPECTS = {
+    "metadata": ("{", {
+        "parties": {"provider": "Unknown", "client": "Unknown"},
+        "contractDate": None,
+        "effectiveDate": None,
+        "expirationDate": None,
+        "contractValue": None,
+        "contractType": "Contract",
+        "governingLaw": None,
+        "disputeResolution": None
+    }),
+    "summary": (None, ""),
+    "obligations": ("{", {"provider": [], "client": []}),
+    "risks": ("[", []),
+    "missing": ("[", []),
+    "key": ("{", {}),
+    "improvements": ("[", []),
+}
+# Aspect name -> key in the analyze_aspects result
+_ASPECT_KEYS = {
+    "metadata": "metadata",
+    "summary": "summary",
+    "obligations": "obligations",
+    "risks": "risks",
+    "missing": "missingClauses",
+    "key": "keyClauses",
+    "improvements": "improvements",
+}
+
+# Opt-in reuse of a previous analysis when a new contract embeds almost identically
+# (re-uploads, the same contract re-exported). Off by default: the threshold must be
+# tight enough that two contracts filled in from one template don't match
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "").lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.97"))
+SEMANTIC_CACHE_TTL = 3600
+SEMANTIC_CACHE_SIZE = 512
+
+
+COMPREHENSIVE_TEMPLATE = """You are a senior international contracts lawyer and enterprise project governance expert.
 
 Analyze this contract WITHOUT assuming any country, governing law, or jurisdiction unless explicitly stated in the document.
 
-Contract Document: {{context}}
+Contract Document: {context}
 
 Return a JSON object with the following structure:
 
@@ -211,78 +255,10 @@ IMPORTANT RULES:
 
 Return ONLY valid JSON, no additional text.
 """
-        
-        # Replace double braces with single for context variable
-        formatted_template = comprehensive_template.replace("{{context}}", "{context}")
-        prompt = PromptTemplate.from_template(formatted_template)
-        chain = prompt | self.llm | self.output_parser
-        
-        try:
-            # Use larger context window for comprehensive analysis
-            result = chain.invoke({"context": content[:15000]})  # Increased for comprehensive international analysis
-            
-            # Parse the comprehensive result
-            if result.strip().startswith('{'):
-                analysis = json.loads(result)
-            else:
-                json_match = re.search(r'\{.*\}', result, re.DOTALL)
-                if json_match:
-                    analysis = json.loads(json_match.group())
-                else:
-                    analysis = {}
-            
-            # Extract all fields with defaults
-            return {
-                "executiveSummary": analysis.get("executiveSummary", []),
-                "partiesAndType": analysis.get("partiesAndType", {
-                    "parties": {"provider": "Unknown", "client": "Unknown"},
-                    "contractType": "Contract",
-                    "governingLaw": None,
-                    "jurisdiction": None
-                }),
-                "scopeAndObligations": analysis.get("scopeAndObligations", {
-                    "scopeOfServices": "",
-                    "providerObligations": [],
-                    "clientObligations": []
-                }),
-                "commercialTerms": analysis.get("commercialTerms", {
-                    "pricing": "",
-                    "paymentTerms": "",
-                    "currency": None,
-                    "paymentMethod": None
-                }),
-                "clauseAnalysis": analysis.get("clauseAnalysis", []),
-                "riskAssessment": analysis.get("riskAssessment", []),
-                "globalCompliance": analysis.get("globalCompliance", {
-                    "dataPrivacyGaps": [],
-                    "crossBorderIssues": [],
-                    "internationalEnforceability": "",
-                    "complianceRecommendations": []
-                }),
-                "optionalImprovements": analysis.get("optionalImprovements", []),
-                "overallRiskLevel": self._calculate_overall_risk(analysis.get("riskAssessment", []))
-            }
-        except Exception as e:
-            print(f"Error in comprehensive contract analysis: {e}")
-            import traceback
-            traceback.print_exc()
-            # Fallback to basic analysis
-            return {
-                "error": f"Error analyzing contract: {str(e)}. Please try again.",
-                "executiveSummary": [],
-                "partiesAndType": {"parties": {"provider": "Unknown", "client": "Unknown"}},
-                "scopeAndObligations": {"scopeOfServices": "", "providerObligations": [], "clientObligations": []},
-                "commercialTerms": {},
-                "clauseAnalysis": [],
-                "riskAssessment": [],
-                "globalCompliance": {},
-                "optionalImprovements": [],
-                "overallRiskLevel": "LOW"
-            }
-    
-    def _extract_metadata(self, retriever) -> Dict[str, Any]:
-        """Extract contract metadata: parties, dates, value, etc."""
-        template = """Extract key metadata from this contract document.
+
+METADATA_TEMPLATE = """Extract key metadata from this contract document.
+
+Already read from the document (use these values as-is): {known_fields}
 
 Context: {context}
 
@@ -298,41 +274,8 @@ Return a JSON object with:
 
 Return ONLY valid JSON, no additional text.
 """
-        
-        def format_docs(docs):
-            return "\n\n".join(doc.page_content for doc in docs)
-        
-        docs = retriever.get_relevant_documents("contract parties dates value") if hasattr(retriever, 'get_relevant_documents') else []
-        content = format_docs(docs) if docs else ""
-        
-        prompt = PromptTemplate.from_template(template)
-        chain = prompt | self.llm | self.output_parser
-        
-        result = chain.invoke({"context": content[:5000]})
-        
-        try:
-            if result.strip().startswith('{'):
-                return json.loads(result)
-            json_match = re.search(r'\{.*\}', result, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-        except:
-            pass
-        
-        return {
-            "parties": {"provider": "Unknown", "client": "Unknown"},
-            "contractDate": None,
-            "effectiveDate": None,
-            "expirationDate": None,
-            "contractValue": None,
-            "contractType": "Contract",
-            "governingLaw": None,
-            "disputeResolution": None
-        }
-    
-    def _get_summary(self, retriever) -> str:
-        """Get executive summary of contract"""
-        template = """Create a comprehensive executive summary of this contract (3-4 paragraphs).
+
+SUMMARY_TEMPLATE = """Create a comprehensive executive summary of this contract (3-4 paragraphs).
 
 Context: {context}
 
@@ -344,13 +287,8 @@ Summary should cover:
 - Risk factors
 
 Summary:"""
-        
-        chain = self._create_chain(template, retriever)
-        return chain.invoke("Summarize contract")
-    
-    def _extract_obligations(self, retriever) -> Dict[str, List[Dict[str, str]]]:
-        """Extract obligations for both parties"""
-        template = """Extract all obligations for both parties from this contract.
+
+OBLIGATIONS_TEMPLATE = """Extract all obligations for both parties from this contract.
 
 Context: {context}
 
@@ -365,44 +303,12 @@ Each obligation should be an object with:
 
 Return ONLY valid JSON, no additional text.
 """
-        
-        def format_docs(docs):
-            return "\n\n".join(doc.page_content for doc in docs)
-        
-        docs = retriever.get_relevant_documents("obligations responsibilities duties") if hasattr(retriever, 'get_relevant_documents') else []
-        content = format_docs(docs) if docs else ""
-        
-        prompt = PromptTemplate.from_template(template)
-        chain = prompt | self.llm | self.output_parser
-        
-        result = chain.invoke({"context": content[:5000]})
-        
-        try:
-            if result.strip().startswith('{'):
-                data = json.loads(result)
-                return {
-                    "provider": data.get("provider", []),
-                    "client": data.get("client", [])
-                }
-            json_match = re.search(r'\{.*\}', result, re.DOTALL)
-            if json_match:
-                data = json.loads(json_match.group())
-                return {
-                    "provider": data.get("provider", []),
-                    "client": data.get("client", [])
-                }
-        except:
-            pass
-        
-        return {"provider": [], "client": []}
-    
-    def _analyze_risks(self, retriever) -> List[Dict[str, str]]:
-        """Analyze contract risks with severity levels"""
-        template = """Analyze this contract for legal, financial, and operational risks.
+
+RISKS_TEMPLATE = """Analyze this contract for legal, financial, and operational risks.
 
 Context: {context}
 
-Return a JSON array of risk objects, each with:
+Return a JSON object with an "items" key holding an array of risk objects, each with:
 - title: brief risk title
 - description: detailed explanation of the risk
 - severity: "high", "medium", or "low"
@@ -418,38 +324,14 @@ Focus on:
 - Confidentiality gaps
 - Dispute resolution problems
 
-Return ONLY valid JSON array, no additional text.
+Return ONLY valid JSON, no additional text.
 """
-        
-        def format_docs(docs):
-            return "\n\n".join(doc.page_content for doc in docs)
-        
-        docs = retriever.get_relevant_documents("risks liabilities termination payment") if hasattr(retriever, 'get_relevant_documents') else []
-        content = format_docs(docs) if docs else ""
-        
-        prompt = PromptTemplate.from_template(template)
-        chain = prompt | self.llm | self.output_parser
-        
-        result = chain.invoke({"context": content[:5000]})
-        
-        try:
-            if result.strip().startswith('['):
-                return json.loads(result)
-            json_match = re.search(r'\[.*\]', result, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-        except:
-            pass
-        
-        return []
-    
-    def _check_missing_clauses(self, retriever) -> List[Dict[str, str]]:
-        """Check for missing important clauses"""
-        template = """Check if this contract is missing any standard or important clauses.
+
+MISSING_CLAUSES_TEMPLATE = """Check if this contract is missing any standard or important clauses.
 
 Context: {context}
 
-Return a JSON array of missing clauses, each with:
+Return a JSON object with an "items" key holding an array of missing clauses, each with:
 - clauseName: name of missing clause
 - importance: "critical", "important", or "recommended"
 - description: why this clause is needed
@@ -467,34 +349,10 @@ Check for:
 - Warranties
 - Indemnification
 
-Return ONLY valid JSON array, no additional text.
+Return ONLY valid JSON, no additional text.
 """
-        
-        def format_docs(docs):
-            return "\n\n".join(doc.page_content for doc in docs)
-        
-        docs = retriever.get_relevant_documents("clauses terms conditions") if hasattr(retriever, 'get_relevant_documents') else []
-        content = format_docs(docs) if docs else ""
-        
-        prompt = PromptTemplate.from_template(template)
-        chain = prompt | self.llm | self.output_parser
-        
-        result = chain.invoke({"context": content[:5000]})
-        
-        try:
-            if result.strip().startswith('['):
-                return json.loads(result)
-            json_match = re.search(r'\[.*\]', result, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-        except:
-            pass
-        
-        return []
-    
-    def _identify_key_clauses(self, retriever) -> Dict[str, str]:
-        """Identify and extract key clauses"""
-        template = """Identify and extract key clauses from this contract.
+
+KEY_CLAUSES_TEMPLATE = """Identify and extract key clauses from this contract.
 
 Context: {context}
 
@@ -512,36 +370,12 @@ For each clause, provide a brief summary (2-3 sentences).
 
 Return ONLY valid JSON, no additional text.
 """
-        
-        def format_docs(docs):
-            return "\n\n".join(doc.page_content for doc in docs)
-        
-        docs = retriever.get_relevant_documents("payment liability termination IP dispute") if hasattr(retriever, 'get_relevant_documents') else []
-        content = format_docs(docs) if docs else ""
-        
-        prompt = PromptTemplate.from_template(template)
-        chain = prompt | self.llm | self.output_parser
-        
-        result = chain.invoke({"context": content[:5000]})
-        
-        try:
-            if result.strip().startswith('{'):
-                return json.loads(result)
-            json_match = re.search(r'\{.*\}', result, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-        except:
-            pass
-        
-        return {}
-    
-    def _suggest_improvements(self, retriever, risks: List[Dict], missing_clauses: List[Dict]) -> List[Dict[str, str]]:
-        """Suggest contract improvements"""
-        template = """Based on the contract analysis, suggest specific improvements.
+
+IMPROVEMENTS_TEMPLATE = """Based on the contract analysis, suggest specific improvements.
 
 Context: {context}
 
-Return a JSON array of improvements, each with:
+Return a JSON object with an "items" key holding an array of improvements, each with:
 - title: improvement title
 - description: detailed explanation
 - priority: "high", "medium", or "low"
@@ -554,38 +388,444 @@ Focus on:
 - Strengthening weak protections
 - Improving fairness
 
-Return ONLY valid JSON array, no additional text.
+Return ONLY valid JSON, no additional text.
 """
+
+
+# Sections of the comprehensive analysis, in response order, with the value used when
+# the model omits one
+_ANALYSIS_DEFAULTS = {
+    "executiveSummary": [],
+    "partiesAndType": {
+        "parties": {"provider": "Unknown", "client": "Unknown"},
+        "contractType": "Contract",
+        "governingLaw": None,
+        "jurisdiction": None
+    },
+    "scopeAndObligations": {
+        "scopeOfServices": "",
+        "providerObligations": [],
+        "clientObligations": []
+    },
+    "commercialTerms": {
+        "pricing": "",
+        "paymentTerms": "",
+        "currency": None,
+        "paymentMethod": None
+    },
+    "clauseAnalysis": [],
+    "riskAssessment": [],
+    "globalCompliance": {
+        "dataPrivacyGaps": [],
+        "crossBorderIssues": [],
+        "internationalEnforceability": "",
+        "complianceRecommendations": []
+    },
+    "optionalImprovements": [],
+}
+
+# Error-path payloads, defined once. They are deep-copied on return rather than handed
+# out as read-only views: jsonify can't serialize MappingProxyType, and a caller editing
+# a shared dict would corrupt every later error response
+_NO_CONTENT_RESPONSE = {
+    "error": (
+        "Could not extract sufficient content from the contract PDF. "
+        "Possible reasons: "
+        "1) The PDF might be image-based/scanned (requires OCR), "
+        "2) The PDF might be corrupted, "
+        "3) The PDF might not contain selectable text. "
+        "Please ensure the PDF contains selectable text or try converting it to a text-based PDF."
+    ),
+    "executiveSummary": [],
+    "partiesAndType": {},
+    "scopeAndObligations": {},
+    "commercialTerms": {},
+    "clauseAnalysis": [],
+    "riskAssessment": [],
+    "globalCompliance": {},
+    "optionalImprovements": []
+}
+_ERROR_RESPONSE = {
+    "error": "",
+    "executiveSummary": [],
+    "partiesAndType": {"parties": {"provider": "Unknown", "client": "Unknown"}},
+    "scopeAndObligations": {"scopeOfServices": "", "providerObligations": [], "clientObligations": []},
+    "commercialTerms": {},
+    "clauseAnalysis": [],
+    "riskAssessment": [],
+    "globalCompliance": {},
+    "optionalImprovements": [],
+    "overallRiskLevel": "LOW"
+}
+
+# Comprehensive calls in flight, keyed by a hash of their exact prompt context
+_inflight: Dict[str, Future] = {}
+_inflight_lock = threading.Lock()
+
+# Analyzers are built per request, so the templates are parsed here, once per process
+_PROMPTS = {
+    name: PromptTemplate.from_template(template)
+    for name, template in (
+        ("comprehensive", COMPREHENSIVE_TEMPLATE),
+        ("metadata", METADATA_TEMPLATE),
+        ("summary", SUMMARY_TEMPLATE),
+        ("obligations", OBLIGATIONS_TEMPLATE),
+        ("risks", RISKS_TEMPLATE),
+        ("missing", MISSING_CLAUSES_TEMPLATE),
+        ("key", KEY_CLAUSES_TEMPLATE),
+        ("improvements", IMPROVEMENTS_TEMPLATE),
+    )
+}
+
+
+class _SemanticCache:
+    """Process-wide LRU of (unit embedding, analysis) with a TTL, matched by cosine similarity"""
+    
+    def __init__(self, threshold: float, ttl: float, size: int):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.size = size
+        self._entries: List[list] = []  # [vector, analysis, stored_at], most recent last
+        self._lock = threading.Lock()
+    
+    def get(self, vector: np.ndarray) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            self._expire()
+            if not self._entries:
+                return None
+            scores = np.stack([e[0] for e in self._entries]) @ vector
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            entry = self._entries.pop(best)
+            self._entries.append(entry)
+            return copy.deepcopy(entry[1])
+    
+    def put(self, vector: np.ndarray, analysis: Dict[str, Any]):
+        with self._lock:
+            self._expire()
+            self._entries.append([vector, copy.deepcopy(analysis), time.monotonic()])
+            del self._entries[:-self.size]
+    
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl
+        self._entries = [e for e in self._entries if e[2] >= cutoff]
+
+
+_semantic_cache = _SemanticCache(SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_SIZE)
+
+
+class ContractAnalyzer:
+    """Professional contract analysis system"""
+    
+    # Retrievers are sync; fallback queries fan out over one pool shared by all analyzers
+    _POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix="contract-retr")
+    
+    @classmethod
+    def shutdown(cls, wait: bool = True):
+        """Stop the shared retrieval pool; called from the gunicorn worker_exit hook"""
+        cls._POOL.shutdown(wait=wait, cancel_futures=True)
+    
+    def __init__(self, openai_api_key: str):
+        from langchain_openai import ChatOpenAI
+        # Use faster model with optimized settings for comprehensive analysis
+        self.llm = ChatOpenAI(
+            model="gpt-4o-mini", 
+            temperature=0.1, 
+            openai_api_key=openai_api_key,
+            max_tokens=6000,  # Increased for comprehensive clause analysis
+            timeout=90,  # 90 second timeout for comprehensive analysis
+            http_client=http_client
+        )
+        self.output_parser = StrOutputParser()
+        # JSON mode: the API guarantees a single JSON object, no preamble or markdown fences
+        self.json_llm = self.llm.bind(response_format={"type": "json_object"})
+        # Prompts are parsed once per process; only the model wiring is per analyzer
+        self._chains = {
+            name: prompt | (self.llm if name == "summary" else self.json_llm) | self.output_parser
+            for name, prompt in _PROMPTS.items()
+        }
+        # Per-retriever memoization; an analyzer lives for one request
+        self._content_cache: Dict[int, str] = {}
+        self.embeddings = None
+        if SEMANTIC_CACHE_ENABLED:
+            from langchain_openai import OpenAIEmbeddings
+            self.embeddings = OpenAIEmbeddings(model="text-embedding-3-small", openai_api_key=openai_api_key)
+    
+    def _content_vector(self, content: str) -> Optional[np.ndarray]:
+        """Unit embedding of the contract for the semantic cache; None when disabled or on failure"""
+        if self.embeddings is None:
+            return None
+        try:
+            vector = np.asarray(self.embeddings.embed_query(content[:6000]), dtype=np.float32)
+            return vector / np.linalg.norm(vector)
+        except Exception as e:
+            print(f"Contract embedding failed, skipping semantic cache: {e}")
+            return None
+    
+    def _retrieve_many(self, retriever, queries: List[str]) -> List[List]:
+        """Run several retrievals concurrently; a failed query yields no documents"""
+        futures = [self._POOL.submit(_retrieve, retriever, query) for query in queries]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception:
+                results.append([])
+        return results
+    
+    def _extract_contract_content(self, retriever):
+        """Extract contract content with multiple fallback strategies - self-contained"""
+        content = ""
+        docs = []
         
-        def format_docs(docs):
-            return "\n\n".join(doc.page_content for doc in docs)
+        # Strategy 1: One union query over contract-specific terms
+        if hasattr(retriever, 'get_relevant_documents'):
+            try:
+                docs = _retrieve(retriever, CONTRACT_QUERY)
+                content = _format_docs(docs)
+            except Exception as e:
+                print(f"Contract search failed: {e}")
         
-        docs = retriever.get_relevant_documents("improvements recommendations") if hasattr(retriever, 'get_relevant_documents') else []
-        content = format_docs(docs) if docs else ""
+        # Strategy 2: Broader search
+        if len(content.strip()) < 200 and hasattr(retriever, 'get_relevant_documents'):
+            broad_queries = ["document", "text", "content"]
+            for temp_docs in self._retrieve_many(retriever, broad_queries):
+                if temp_docs:
+                    temp_content = _format_docs(temp_docs)
+                    if len(temp_content.strip()) > len(content.strip()):
+                        content = temp_content
+                        docs = temp_docs
         
-        prompt = PromptTemplate.from_template(template)
-        chain = prompt | self.llm | self.output_parser
+        # Strategy 3: Direct vectorstore access
+        if len(content.strip()) < 200:
+            vectorstore = getattr(retriever, 'vectorstore', None) or getattr(retriever, '_vectorstore', None)
+            if vectorstore:
+                try:
+                    all_docs = stored_docs(vectorstore, limit=200)
+                    if all_docs:
+                        temp_content = _format_docs(all_docs)
+                        if len(temp_content.strip()) > len(content.strip()):
+                            content = temp_content
+                            docs = all_docs
+                except Exception as e:
+                    print(f"Direct contract chunk read failed: {e}")
         
-        result = chain.invoke({"context": content[:5000]})
+        return content, docs
+    
+    def analyze_contract(self, retriever) -> Dict[str, Any]:
+        """Comprehensive international contract analysis - globally neutral approach"""
+        return self.analyze_contracts_batch([retriever])[0]
+    
+    def analyze_contracts_batch(self, retrievers: List) -> List[Dict[str, Any]]:
+        """Analyze several contracts, sending their comprehensive calls as one concurrent batch"""
+        responses: List[Optional[Dict[str, Any]]] = [None] * len(retrievers)
+        pending = []
+        for n, retriever in enumerate(retrievers):
+            # Self-contained extraction
+            content, docs = self._extract_contract_content(retriever)
+            
+            # Final check - be more lenient
+            if not content or len(content.strip()) < 20:
+                responses[n] = self._no_content_response(content, docs)
+                continue
+            
+            print(f"Contract content extracted: {len(content)} characters from {len(docs) if docs else 0} document chunks")
+            
+            vector = self._content_vector(content)
+            if vector is not None:
+                cached = _semantic_cache.get(vector)
+                if cached is not None:
+                    print("Contract analysis served from semantic cache")
+                    responses[n] = cached
+                    continue
+            pending.append((n, content, vector))
+        
+        # Single-flight: a contract whose exact prompt is already being analyzed (by another
+        # request or earlier in this batch) waits for that call instead of making its own
+        owned, waiting = [], []
+        with _inflight_lock:
+            for n, content, vector in pending:
+                # Comprehensive international contract analysis; larger context window than the aspect prompts
+                context = trim_text(content, COMPREHENSIVE_TOKENS, COMPREHENSIVE_CHARS)
+                key = hashlib.sha256(context.encode("utf-8")).hexdigest()
+                future = _inflight.get(key)
+                if future is None:
+                    future = _inflight[key] = Future()
+                    owned.append((n, key, context, vector, future))
+                else:
+                    waiting.append((n, vector, future))
         
+        if owned:
+            results = None
+            try:
+                results = self._chains["comprehensive"].batch(
+                    [{"context": context} for _, _, context, _, _ in owned],
+                    config={"max_concurrency": 8},
+                    return_exceptions=True
+                )
+            except Exception as e:
+                results = [e] * len(owned)
+            finally:
+                # Waiters must never be left hanging, whatever happened above
+                if results is None:
+                    results = [RuntimeError("Contract analysis was interrupted")] * len(owned)
+                with _inflight_lock:
+                    for _, key, _, _, _ in owned:
+                        _inflight.pop(key, None)
+                for (_, _, _, _, future), result in zip(owned, results):
+                    future.set_result(result)
+            for (n, _, _, vector, _), result in zip(owned, results):
+                responses[n] = self._build_response(result, vector)
+        for n, vector, future in waiting:
+            responses[n] = self._build_response(future.result(), vector)
+        return responses
+    
+    @staticmethod
+    def _no_content_response(content: str, docs) -> Dict[str, Any]:
+        print(f"ERROR: Contract extraction failed. Content length: {len(content) if content else 0} characters")
+        print(f"Number of docs retrieved: {len(docs) if docs else 0}")
+        return copy.deepcopy(_NO_CONTENT_RESPONSE)
+    
+    def _build_response(self, result, vector: Optional[np.ndarray]) -> Dict[str, Any]:
+        """Turn one comprehensive reply (or the exception it raised) into the API response"""
         try:
-            if result.strip().startswith('['):
-                return json.loads(result)
-            json_match = re.search(r'\[.*\]', result, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-        except:
-            pass
-        
-        return []
+            if isinstance(result, Exception):
+                raise result
+            
+            # Parse the comprehensive result
+            analysis = _parse_json_lenient(result)
+            if not isinstance(analysis, dict):
+                print("Comprehensive contract analysis returned no parseable JSON object")
+                analysis = {}
+            
+            # Canonical upper-case risk levels, normalized once for the response and the tally
+            risks = [r for r in analysis.get("riskAssessment", []) if isinstance(r, dict)]
+            for risk in risks:
+                risk["riskLevel"] = str(risk.get("riskLevel") or "").upper()
+            
+            # Extract all fields; defaults are copied only for sections the model left out
+            response = {
+                key: analysis[key] if key in analysis else copy.deepcopy(default)
+                for key, default in _ANALYSIS_DEFAULTS.items()
+            }
+            response["riskAssessment"] = risks
+            response["overallRiskLevel"] = self._calculate_overall_risk(risks)
+            if vector is not None and analysis:
+                _semantic_cache.put(vector, response)
+            return response
+        except Exception as e:
+            print(f"Error in comprehensive contract analysis: {e}")
+            import traceback
+            traceback.print_exc()
+            # Fallback to basic analysis
+            response = copy.deepcopy(_ERROR_RESPONSE)
+            response["error"] = f"Error analyzing contract: {str(e)}. Please try again."
+            return response
+    
+    def _get_content(self, retriever) -> str:
+        """Contract text for the aspect prompts, retrieved once per retriever"""
+        key = id(retriever)
+        if key not in self._content_cache:
+            docs = _retrieve(retriever, ASPECT_QUERY) if hasattr(retriever, 'get_relevant_documents') else []
+            unique = list({doc.page_content: doc for doc in docs}.values())
+            self._content_cache[key] = _format_docs(unique)
+        return self._content_cache[key]
+    
+    @staticmethod
+    def _parse_aspect(name: str, result: str):
+        """Parse one aspect's reply, falling back to that aspect's default"""
+        opener, default = _ASPECTS[name]
+        if opener is None:
+            return result
+        data = _parse_json_lenient(result)
+        if opener == '[':
+            data = data.get("items") if isinstance(data, dict) else _parse_json_lenient(result, '[')
+            if not isinstance(data, list):
+                return copy.deepcopy(default)
+        if data is None:
+            return copy.deepcopy(default)
+        if name == "obligations":
+            if not isinstance(data, dict):
+                return copy.deepcopy(default)
+            return {"provider": data.get("provider", []), "client": data.get("client", [])}
+        return data
+    
+    @staticmethod
+    def _aspect_inputs(name: str, content: str):
+        """Prompt inputs for an aspect, plus any fields already read by regex"""
+        context = content if name == "summary" else trim_text(content, ASPECT_TOKENS, ASPECT_CHARS)
+        if name != "metadata":
+            return {"context": context}, {}
+        prefill = _regex_metadata(context)
+        return {"context": context, "known_fields": json.dumps(prefill) if prefill else "none"}, prefill
+    
+    def _finish_aspect(self, name: str, result: str, prefill: Dict[str, str]):
+        data = self._parse_aspect(name, result)
+        # Deterministic regex hits take precedence over the model's reading
+        if prefill and isinstance(data, dict):
+            data.update(prefill)
+        return data
+    
+    def _run_aspect(self, name: str, retriever):
+        inputs, prefill = self._aspect_inputs(name, self._get_content(retriever))
+        # Nothing retrieved: the prompt could only produce the default, so skip the call
+        if not inputs["context"].strip():
+            return copy.deepcopy(_ASPECTS[name][1])
+        return self._finish_aspect(name, self._chains[name].invoke(inputs), prefill)
+    
+    def analyze_aspects(self, retriever) -> Dict[str, Any]:
+        """Fine-grained analysis: every per-aspect prompt, all in flight at once"""
+        # Retrieve up front so the aspect threads all read the cached content
+        self._get_content(retriever)
+        names = list(_ASPECTS)
+        with ThreadPoolExecutor(max_workers=len(names)) as pool:
+            futures = [pool.submit(self._run_aspect, name, retriever) for name in names]
+        analysis = {}
+        for name, future in zip(names, futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Contract {name} analysis failed: {e}")
+                result = copy.deepcopy(_ASPECTS[name][1])
+            analysis[_ASPECT_KEYS[name]] = result
+        return analysis
+    
+    def _extract_metadata(self, retriever) -> Dict[str, Any]:
+        """Extract contract metadata: parties, dates, value, etc."""
+        return self._run_aspect("metadata", retriever)
+    
+    def _get_summary(self, retriever) -> str:
+        """Get executive summary of contract"""
+        return self._run_aspect("summary", retriever)
+    
+    def _extract_obligations(self, retriever) -> Dict[str, List[Dict[str, str]]]:
+        """Extract obligations for both parties"""
+        return self._run_aspect("obligations", retriever)
+    
+    def _analyze_risks(self, retriever) -> List[Dict[str, str]]:
+        """Analyze contract risks with severity levels"""
+        return self._run_aspect("risks", retriever)
+    
+    def _check_missing_clauses(self, retriever) -> List[Dict[str, str]]:
+        """Check for missing important clauses"""
+        return self._run_aspect("missing", retriever)
+    
+    def _identify_key_clauses(self, retriever) -> Dict[str, str]:
+        """Identify and extract key clauses"""
+        return self._run_aspect("key", retriever)
+    
+    def _suggest_improvements(self, retriever, risks: List[Dict], missing_clauses: List[Dict]) -> List[Dict[str, str]]:
+        """Suggest contract improvements"""
+        # The prompt works from the contract text alone, so it need not wait for risks/missing clauses
+        return self._run_aspect("improvements", retriever)
     
     def _calculate_overall_risk(self, risks: List[Dict]) -> str:
         """Calculate overall risk level"""
-        if not risks:
-            return "LOW"
-        
-        high_count = sum(1 for r in risks if r.get("riskLevel", "").upper() == "HIGH")
-        medium_count = sum(1 for r in risks if r.get("riskLevel", "").upper() == "MEDIUM")
+        # One pass; riskLevel is already upper-cased when the analysis is parsed
+        levels = Counter(r.get("riskLevel") for r in risks)
+        high_count = levels["HIGH"]
+        medium_count = levels["MEDIUM"]
         
         if high_count >= 2:
             return "HIGH"
@@ -1,9 +1,19 @@
 # Gunicorn configuration file
 bind = "0.0.0.0:8080"
-workers = 2
-worker_class = "sync"
+# Uploaded documents live in in-process memory (retriever_cache), so a single
+# worker keeps them visible to every request; threads give the concurrency
+# while requests sit waiting on OpenAI.
+workers = 1
+worker_class = "gthread"
+threads = 16
 timeout = 120
 keepalive = 5
-max_requests = 1000
-max_requests_jitter = 50
 
+
+def worker_exit(server, worker):
+    # Release the contract analyzer's shared retrieval threads with the worker
+    try:
+        from contract_analyzer import ContractAnalyzer
+    except ImportError:
+        return
+    ContractAnalyzer.shutdown()
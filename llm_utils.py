@@ -0,0 +1,106 @@
+"""
+Shared LLM Helpers
+JSON parsing, prompt trimming, stored-chunk reads and the pooled HTTP client used by the analyzers
+"""
+import json
+from typing import List, Optional
+import httpx
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import h2  # noqa: F401 - enables HTTP/2 in httpx
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("o200k_base")  # gpt-4o-mini tokenizer
+except Exception:
+    _ENCODING = None
+
+# One pooled HTTP client for every OpenAI call in the process. Analyzers are built
+# per request, so a per-instance client would redo TCP+TLS each time. The analyzers
+# call the models synchronously only: langchain-openai's default AsyncClient is
+# cached process-wide, so reusing it from a second asyncio.run() fails with
+# "Event loop is closed"
+http_client = httpx.Client(
+    http2=_HTTP2,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+    timeout=httpx.Timeout(90.0)
+)
+
+
+def loads(data):
+    """Parse JSON with orjson when available, falling back to the stdlib parser"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def trim_text(text: str, max_tokens: int, max_chars: int) -> str:
+    """Cut text to a prompt budget, in tokens when tiktoken is available and characters otherwise"""
+    if _ENCODING is None:
+        return text[:max_chars]
+    tokens = _ENCODING.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return _ENCODING.decode(tokens[:max_tokens])
+
+
+def extract_json_span(text: str, opener: str = None) -> Optional[str]:
+    """Return the first balanced JSON object/array in text, or None.
+    
+    Single pass that tracks bracket depth and skips over string literals, so
+    braces inside values or trailing chatter after the JSON don't confuse it.
+    """
+    if opener is None:
+        starts = [i for i in (text.find('{'), text.find('[')) if i != -1]
+        if not starts:
+            return None
+        start = min(starts)
+    else:
+        start = text.find(opener)
+        if start == -1:
+            return None
+    
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in '{[':
+            depth += 1
+        elif ch in '}]':
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+
+def stored_docs(vectorstore, limit: int = 500) -> List:
+    """Every stored chunk in document order, read straight from a FAISS docstore.
+    
+    Avoids embedding a dummy query and running a search just to list the chunks
+    (the embeddings API rejects an empty query); other stores yield nothing.
+    """
+    docstore = getattr(vectorstore, "docstore", None)
+    index_to_id = getattr(vectorstore, "index_to_docstore_id", None)
+    if docstore is None or index_to_id is None or not hasattr(docstore, "_dict"):
+        return []
+    stored = docstore._dict
+    ids = [index_to_id[n] for n in sorted(index_to_id)[:limit]]
+    return [stored[i] for i in ids if i in stored]
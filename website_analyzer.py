@@ -2,6 +2,7 @@
 Website Analyzer Module
 Handles SEO analysis, content structure, keyword extraction, and recommendations
 """
+import io
 import json
 import re
 import os
@@ -13,6 +14,57 @@ from langchain_core.runnables import RunnablePassthrough
 import requests
 from bs4 import BeautifulSoup
 
+# Upper bound on how much of a fetched page is read and handed to BeautifulSoup
+MAX_HTML_BYTES = 2_000_000
+
+FETCH_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5'
+}
+
+
+def fetch_html(url: str) -> str:
+    """Fetch a page's HTML, streaming at most MAX_HTML_BYTES of the body"""
+    with requests.get(url, stream=True, timeout=15, headers=FETCH_HEADERS, allow_redirects=True) as page:
+        page.raise_for_status()
+        buf = io.BytesIO()
+        for chunk in page.iter_content(65536):
+            buf.write(chunk)
+            if buf.tell() > MAX_HTML_BYTES:
+                break
+        encoding = page.encoding or "utf-8"
+    body = buf.getvalue()[:MAX_HTML_BYTES]
+    try:
+        return body.decode(encoding, "replace")
+    except LookupError:
+        return body.decode("utf-8", "replace")
+
+
+def collect_links_and_images(soup, max_links: int = 50, max_images: int = 20):
+    """Unique link hrefs and image sources in page order, stopping once each limit is reached"""
+    seen = set()
+    links = []
+    for a in soup.find_all('a', href=True):
+        href = a['href']
+        if href and href not in seen:
+            seen.add(href)
+            links.append(href)
+            if len(links) >= max_links:
+                break
+    
+    # Tags without a source are skipped
+    seen.clear()
+    images = []
+    for img in soup.find_all('img'):
+        src = img.get('src') or img.get('data-src')
+        if src and src not in seen:
+            seen.add(src)
+            images.append(src)
+            if len(images) >= max_images:
+                break
+    return links, images
+
 
 class WebsiteAnalyzer:
     def __init__(self, openai_key: str):
@@ -22,10 +74,8 @@ class WebsiteAnalyzer:
     def fetch_website_content(self, url: str) -> Dict[str, Any]:
         """Fetch and parse website content"""
         try:
-            response = requests.get(url, timeout=10, headers={
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            })
-            soup = BeautifulSoup(response.text, 'html.parser')
+            html = fetch_html(url)
+            soup = BeautifulSoup(html, 'html.parser')
             
             # Extract meta tags
             title = soup.find('title')
@@ -37,11 +87,7 @@ class WebsiteAnalyzer:
             h2_tags = [h.get_text().strip() for h in soup.find_all('h2')]
             h3_tags = [h.get_text().strip() for h in soup.find_all('h3')]
             
-            # Extract links
-            links = [a.get('href') for a in soup.find_all('a', href=True)]
-            
-            # Extract images
-            images = [img.get('src') or img.get('data-src') for img in soup.find_all('img')]
+            links, images = collect_links_and_images(soup)
             
             # Get main content
             main_content = soup.get_text()
@@ -54,10 +100,10 @@ class WebsiteAnalyzer:
                 "h1Tags": h1_tags,
                 "h2Tags": h2_tags,
                 "h3Tags": h3_tags,
-                "links": links[:50],  # Limit to first 50
-                "images": images[:20],  # Limit to first 20
+                "links": links,
+                "images": images,
                 "content": main_content[:10000],  # Limit content length
-                "html": response.text[:5000]  # Limit HTML
+                "html": html[:5000]  # Limit HTML
             }
         except Exception as e:
             return {"error": str(e), "url": url}
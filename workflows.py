@@ -2,111 +2,165 @@
 Workflow Processing Module
 Handles all workflow types: Extract Insights, Action Items, Summaries, etc.
 """
-import json
 from typing import Dict, List, Any, Optional
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
 import os
+from llm_utils import extract_json_span, loads
+
+def _strip_fences(text: str) -> str:
+    """Remove a surrounding ```json ... ``` markdown fence, if present"""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text[3:]
+        if text[:4].lower() == "json":
+            text = text[4:]
+        if text.endswith("```"):
+            text = text[:-3]
+    return text.strip()
+
+
+def _safe_json(result: str, default: Any, expect: str = '{') -> Any:
+    """Parse a model reply as JSON, returning default if nothing parseable is found.
+    
+    Clean (or fenced) replies go straight to the parser; the bracket scanner is
+    only used when the JSON is surrounded by other text.
+    """
+    text = _strip_fences(result)
+    if text.startswith(expect):
+        try:
+            return loads(text)
+        except ValueError:
+            pass
+    json_span = extract_json_span(text, expect)
+    if json_span:
+        try:
+            return loads(json_span)
+        except ValueError:
+            pass
+    return default
+
+
+INSIGHTS_TEMPLATE = """Analyze the following document and extract key insights in JSON format.
+
+Document Type: {document_type}
+Context: {context}
+
+Extract and return a JSON object with:
+- keyEntities: [list of important entities, people, companies, dates]
+- keyFindings: [list of important findings or facts]
+- issues: [list of issues, errors, or concerns]
+- opportunities: [list of opportunities or recommendations]
+- risks: [list of potential risks]
+- summary: brief overall summary
+
+Return ONLY valid JSON, no additional text.
+"""
+
+ACTION_ITEMS_TEMPLATE = """Extract action items from the following document.
+
+Context: {context}
+
+Return a JSON array of action items, each with:
+- title: action item title
+- description: detailed description
+- priority: "high", "medium", or "low"
+- assignee: suggested assignee (if mentioned)
+- dueDate: suggested due date (if mentioned)
+
+Return ONLY valid JSON array, no additional text.
+"""
+
+EMAIL_DRAFT_TEMPLATE = """Based on the following document, create an email draft.
+
+Email Type: {email_type}
+Context: {context}
+
+Return a JSON object with:
+- subject: email subject line
+- body: email body (formatted)
+- recipients: suggested recipients (if mentioned)
+
+Return ONLY valid JSON, no additional text.
+"""
+
+RISK_ANALYSIS_TEMPLATE = """Analyze the following document for risks and create a risk analysis.
+
+Context: {context}
+
+Return a JSON object with:
+- risks: [array of risk objects with: title, description, severity (high/medium/low), mitigation]
+- overallRiskLevel: "high", "medium", or "low"
+- recommendations: [array of recommendations]
+
+Return ONLY valid JSON, no additional text.
+"""
 
 
 class WorkflowProcessor:
     def __init__(self, openai_key: str):
         self.llm = ChatOpenAI(temperature=0, openai_api_key=openai_key)
+        # JSON mode for prompts that return an object; the API then guarantees
+        # parseable output and _safe_json never needs its fallback scan
+        self.json_llm = self.llm.bind(response_format={"type": "json_object"})
         self.output_parser = StrOutputParser()
+        # Fixed prompts are parsed once per processor rather than on every call
+        self._insights_prompt = PromptTemplate.from_template(INSIGHTS_TEMPLATE)
+        self._action_items_prompt = PromptTemplate.from_template(ACTION_ITEMS_TEMPLATE)
+        self._email_draft_prompt = PromptTemplate.from_template(EMAIL_DRAFT_TEMPLATE)
+        self._risk_analysis_prompt = PromptTemplate.from_template(RISK_ANALYSIS_TEMPLATE)
     
-    def _create_chain(self, template: str, retriever):
-        """Create a LangChain chain for processing"""
-        prompt = PromptTemplate.from_template(template)
+    def _create_chain(self, template, retriever, context: Optional[str] = None, llm=None):
+        """Create a LangChain chain for processing.
+        
+        template may be a template string or an already-built PromptTemplate.
+        When the caller already has the document text, pass it as context to
+        skip the retrieval (query embedding + vector search).
+        """
+        if isinstance(template, PromptTemplate):
+            prompt = template
+        else:
+            prompt = PromptTemplate.from_template(template)
         
         def format_docs(docs):
             return "\n\n".join(doc.page_content for doc in docs)
         
+        if context is not None:
+            context_source = lambda _: context
+        else:
+            context_source = retriever | format_docs
+        
         chain = (
-            {"context": retriever | format_docs, "question": RunnablePassthrough()}
+            {"context": context_source, "question": RunnablePassthrough()}
             | prompt
-            | self.llm
+            | (llm or self.llm)
             | self.output_parser
         )
         return chain
     
-    def extract_insights(self, retriever, document_type: str = "general") -> Dict[str, Any]:
+    def extract_insights(self, retriever, document_type: str = "general", context: Optional[str] = None) -> Dict[str, Any]:
         """Extract key insights from document"""
-        template = """Analyze the following document and extract key insights in JSON format.
-        
-Document Type: {document_type}
-Context: {{context}}
-
-Extract and return a JSON object with:
-- keyEntities: [list of important entities, people, companies, dates]
-- keyFindings: [list of important findings or facts]
-- issues: [list of issues, errors, or concerns]
-- opportunities: [list of opportunities or recommendations]
-- risks: [list of potential risks]
-- summary: brief overall summary
-
-Return ONLY valid JSON, no additional text.
-"""
-        
-        # Format document_type, then replace double braces with single for context
-        formatted_template = template.format(document_type=document_type).replace("{{context}}", "{context}")
-        chain = self._create_chain(formatted_template, retriever)
+        prompt = self._insights_prompt.partial(document_type=document_type)
+        chain = self._create_chain(prompt, retriever, context, self.json_llm)
         result = chain.invoke("Extract insights")
         
-        try:
-            # Try to parse JSON from result
-            if result.strip().startswith('{'):
-                return json.loads(result)
-            else:
-                # Extract JSON if wrapped in text
-                import re
-                json_match = re.search(r'\{.*\}', result, re.DOTALL)
-                if json_match:
-                    return json.loads(json_match.group())
-        except:
-            pass
-        
-        # Fallback: return structured text
-        return {
+        return _safe_json(result, {
             "keyEntities": [],
             "keyFindings": [],
             "issues": [],
             "opportunities": [],
             "risks": [],
             "summary": result
-        }
+        })
     
-    def generate_action_items(self, retriever) -> List[Dict[str, str]]:
+    def generate_action_items(self, retriever, context: Optional[str] = None) -> List[Dict[str, str]]:
         """Generate actionable items from document"""
-        template = """Extract action items from the following document.
-        
-Context: {context}
-
-Return a JSON array of action items, each with:
-- title: action item title
-- description: detailed description
-- priority: "high", "medium", or "low"
-- assignee: suggested assignee (if mentioned)
-- dueDate: suggested due date (if mentioned)
-
-Return ONLY valid JSON array, no additional text.
-"""
-        
-        chain = self._create_chain(template, retriever)
+        chain = self._create_chain(self._action_items_prompt, retriever, context)
         result = chain.invoke("Extract action items")
         
-        try:
-            if result.strip().startswith('['):
-                return json.loads(result)
-            import re
-            json_match = re.search(r'\[.*\]', result, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-        except:
-            pass
-        
-        return [{"title": "Review document", "description": result[:200], "priority": "medium"}]
+        return _safe_json(result, [{"title": "Review document", "description": result[:200], "priority": "medium"}], '[')
     
     def create_summary(self, retriever, summary_type: str = "executive") -> str:
         """Create summary of document"""
@@ -127,72 +181,26 @@ Summary:"""
     
     def generate_email_draft(self, retriever, email_type: str = "summary") -> Dict[str, str]:
         """Generate email draft based on document"""
-        template = """Based on the following document, create an email draft.
-        
-Email Type: {email_type}
-Context: {{context}}
-
-Return a JSON object with:
-- subject: email subject line
-- body: email body (formatted)
-- recipients: suggested recipients (if mentioned)
-
-Return ONLY valid JSON, no additional text.
-"""
-        
-        # Format email_type, then replace double braces with single for context
-        formatted_template = template.format(email_type=email_type).replace("{{context}}", "{context}")
-        chain = self._create_chain(formatted_template, retriever)
+        prompt = self._email_draft_prompt.partial(email_type=email_type)
+        chain = self._create_chain(prompt, retriever, llm=self.json_llm)
         result = chain.invoke("Generate email")
         
-        try:
-            if result.strip().startswith('{'):
-                return json.loads(result)
-            import re
-            json_match = re.search(r'\{.*\}', result, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-        except:
-            pass
-        
-        return {
+        return _safe_json(result, {
             "subject": "Document Summary",
             "body": result,
             "recipients": []
-        }
+        })
     
-    def produce_risk_analysis(self, retriever) -> Dict[str, Any]:
+    def produce_risk_analysis(self, retriever, context: Optional[str] = None) -> Dict[str, Any]:
         """Produce risk analysis from document"""
-        template = """Analyze the following document for risks and create a risk analysis.
-        
-Context: {context}
-
-Return a JSON object with:
-- risks: [array of risk objects with: title, description, severity (high/medium/low), mitigation]
-- overallRiskLevel: "high", "medium", or "low"
-- recommendations: [array of recommendations]
-
-Return ONLY valid JSON, no additional text.
-"""
-        
-        chain = self._create_chain(template, retriever)
+        chain = self._create_chain(self._risk_analysis_prompt, retriever, context, self.json_llm)
         result = chain.invoke("Analyze risks")
         
-        try:
-            if result.strip().startswith('{'):
-                return json.loads(result)
-            import re
-            json_match = re.search(r'\{.*\}', result, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-        except:
-            pass
-        
-        return {
+        return _safe_json(result, {
             "risks": [],
             "overallRiskLevel": "medium",
             "recommendations": []
-        }
+        })
     
     def compare_documents(self, retriever1, retriever2, comparison_type: str = "general") -> Dict[str, Any]:
         """Compare two documents"""
@@ -215,28 +223,18 @@ Return ONLY valid JSON, no additional text.
         
         # Use a simple chain for comparison
         prompt = PromptTemplate.from_template(template)
-        chain = prompt | self.llm | self.output_parser
+        chain = prompt | self.json_llm | self.output_parser
         
         result = chain.invoke({
             "summary1": summary1,
             "summary2": summary2
         })
         
-        try:
-            if result.strip().startswith('{'):
-                return json.loads(result)
-            import re
-            json_match = re.search(r'\{.*\}', result, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-        except:
-            pass
-        
-        return {
+        return _safe_json(result, {
             "similarities": [],
             "differences": [result],
             "recommendations": []
-        }
+        })
 
 
 